@@ -0,0 +1,135 @@
+"""asyncio backend for the STUN/TURN protocols
+
+The protocols only use a small part of the Twisted reactor interface:
+`listenUDP`, `adoptDatagramPort`, `callLater` and `seconds`, and write to
+the `transport` of their UDP ports. `AsyncioReactor` provides that interface
+on an asyncio event loop, so a server can be embedded in an asyncio
+application:
+
+    loop = new_event_loop()
+    server = TurnUdpServer(AsyncioReactor(loop), interface, port, ...)
+    server.start()
+    loop.run_forever()
+
+Sockets are bound synchronously, as relays are allocated from within the
+request handlers, and read with `loop.add_reader`.
+"""
+
+import asyncio
+import collections
+import logging
+import socket
+
+
+logger = logging.getLogger(__name__)
+
+
+UDPAddress = collections.namedtuple("UDPAddress", "type host port")
+
+
+def new_event_loop():
+    """Create a uvloop event loop if uvloop is installed, otherwise the
+    default asyncio event loop
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class AsyncioUdpPort(object):
+    """A UDP socket read by an asyncio event loop, delivering datagrams to a
+    Twisted style `DatagramProtocol`, which writes through this port as its
+    transport
+    """
+
+    maxPacketSize = 8192
+    # Maximum number of datagrams read per wakeup, before yielding to the loop
+    maxReads = 256
+
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.socket = sock
+        self.addressFamily = sock.family
+        self.protocol = protocol
+        self.port = sock.getsockname()[1]
+
+    def startListening(self):
+        self.socket.setblocking(False)
+        self.protocol.makeConnection(self)
+        self.loop.add_reader(self.socket.fileno(), self._read)
+
+    def stopListening(self):
+        if self.socket.fileno() != -1:
+            self.loop.remove_reader(self.socket.fileno())
+            self.socket.close()
+            self.protocol.doStop()
+
+    def _read(self):
+        # Read every datagram queued since the wakeup, up to maxReads
+        recvfrom = self.socket.recvfrom
+        for _ in range(self.maxReads):
+            if self.socket.fileno() == -1:
+                return
+            try:
+                datagram, addr = recvfrom(self.maxPacketSize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            try:
+                self.protocol.datagramReceived(datagram, addr[:2])
+            except Exception:
+                logger.exception("Unhandled error in %r", self.protocol)
+
+    def write(self, datagram, addr):
+        try:
+            return self.socket.sendto(datagram, addr)
+        except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+            # UDP is unreliable, drop the datagram like a full socket buffer
+            pass
+
+    def getHost(self):
+        host, port = self.socket.getsockname()[:2]
+        return UDPAddress("UDP", host, port)
+
+    def __repr__(self):
+        return "<AsyncioUdpPort {} on {}>".format(self.protocol, self.port)
+
+
+class AsyncioReactor(object):
+    """The parts of the Twisted reactor interface used by the protocols,
+    implemented on an asyncio event loop
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, callable, *args):
+        return self.loop.call_later(delay, callable, *args)
+
+    def listenUDP(self, port, protocol, interface="", maxPacketSize=8192):
+        family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.bind((interface, port))
+        except OSError:
+            sock.close()
+            raise
+        return self._listen(sock, protocol, maxPacketSize)
+
+    def adoptDatagramPort(
+        self, fileDescriptor, addressFamily, protocol, maxPacketSize=8192
+    ):
+        sock = socket.fromfd(fileDescriptor, addressFamily, socket.SOCK_DGRAM)
+        return self._listen(sock, protocol, maxPacketSize)
+
+    def _listen(self, sock, protocol, maxPacketSize):
+        port = AsyncioUdpPort(self.loop, sock, protocol)
+        port.maxPacketSize = maxPacketSize
+        port.startListening()
+        return port
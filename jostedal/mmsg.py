@@ -0,0 +1,284 @@
+"""Batched UDP I/O with the Linux recvmmsg(2) and sendmmsg(2) system calls
+
+`BatchUdpPort` is a Twisted UDP port that reads up to `batch_size`
+datagrams per wakeup with a single recvmmsg call. Datagrams written by any
+batch port while a received batch is dispatched are queued, and flushed with
+one sendmmsg call per port when the batch has been dispatched.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import functools
+import logging
+import socket
+import struct
+import sys
+from twisted.internet import error, udp
+from twisted.python import log
+from jostedal.utils import address_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(mmsghdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        libc.sendmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+        ]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+available = _libc is not None
+
+_family_struct = struct.Struct("=H")
+_port_struct = struct.Struct(">H")
+
+
+@functools.lru_cache(maxsize=4096)
+def _encode_sockaddr(family, host, port):
+    packed_ip = address_cache.pton(family, host)
+    if family == socket.AF_INET:
+        # sockaddr_in: family, port, address, padding
+        return (
+            _family_struct.pack(family)
+            + _port_struct.pack(port)
+            + packed_ip
+            + bytes(8)
+        )
+    # sockaddr_in6: family, port, flowinfo, address, scope id
+    return (
+        _family_struct.pack(family)
+        + _port_struct.pack(port)
+        + bytes(4)
+        + packed_ip
+        + bytes(4)
+    )
+
+
+def _decode_sockaddr(sockaddr):
+    (family,) = _family_struct.unpack_from(sockaddr)
+    (port,) = _port_struct.unpack_from(sockaddr, 2)
+    if family == socket.AF_INET:
+        return address_cache.ntop(family, bytes(sockaddr[4:8])), port
+    return address_cache.ntop(family, bytes(sockaddr[8:24])), port
+
+
+class RecvBatch(object):
+    """Preallocated message headers and buffers for recvmmsg"""
+
+    def __init__(self, size, max_packet_size):
+        self.size = size
+        self._buffers = [
+            ctypes.create_string_buffer(max_packet_size) for _ in range(size)
+        ]
+        self._names = [
+            ctypes.create_string_buffer(SOCKADDR_SIZE) for _ in range(size)
+        ]
+        self._addresses = [ctypes.addressof(buffer) for buffer in self._buffers]
+        self._iovecs = (iovec * size)()
+        self._msgs = (mmsghdr * size)()
+        for i in range(size):
+            self._iovecs[i].iov_base = self._addresses[i]
+            self._iovecs[i].iov_len = max_packet_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._names[i])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, fd):
+        """Receive up to `size` datagrams without blocking
+        :returns: list of (datagram, (host, port))
+        """
+        for i in range(self.size):
+            self._msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        count = _libc.recvmmsg(fd, self._msgs, self.size, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "recvmmsg: " + errno.errorcode.get(err, str(err)))
+        datagrams = []
+        for i in range(count):
+            msg = self._msgs[i]
+            if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                continue
+            datagram = ctypes.string_at(self._addresses[i], msg.msg_len)
+            datagrams.append((datagram, _decode_sockaddr(self._names[i])))
+        return datagrams
+
+
+def sendmmsg(fd, family, datagrams):
+    """Send a list of (datagram, (host, port)) with as few sendmmsg calls as
+    possible. Datagrams that can not be sent are dropped.
+    :returns: the number of datagrams sent
+    """
+    encoded = []
+    for datagram, addr in datagrams:
+        try:
+            encoded.append((datagram, _encode_sockaddr(family, *addr[:2])))
+        except (OSError, TypeError, ValueError):
+            logger.warning("Dropping datagram to invalid address %r", addr)
+    count = len(encoded)
+    msgs = (mmsghdr * count)()
+    iovecs = (iovec * count)()
+    keep = []  # Keep buffers alive until sent
+    for i, (datagram, sockaddr) in enumerate(encoded):
+        data = ctypes.c_char_p(datagram)
+        name = ctypes.c_char_p(sockaddr)
+        keep.append((data, name))
+        iovecs[i].iov_base = ctypes.cast(data, ctypes.c_void_p)
+        iovecs[i].iov_len = len(datagram)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.cast(name, ctypes.c_void_p)
+        hdr.msg_namelen = 16 if family == socket.AF_INET else 28
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+    sent = 0
+    offset = 0
+    while offset < count:
+        first = ctypes.addressof(msgs) + offset * ctypes.sizeof(mmsghdr)
+        result = _libc.sendmmsg(fd, first, count - offset, 0)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            # Drop the datagram that failed, and carry on with the rest
+            logger.debug("sendmmsg failed: %s", errno.errorcode.get(err, err))
+            offset += 1
+        else:
+            sent += result
+            offset += result
+    return sent
+
+
+class _Batch(object):
+    """Tracks whether a received batch is being dispatched, and which ports
+    have datagrams queued for sending once it has been
+    """
+
+    depth = 0
+    pending = []
+
+    @classmethod
+    def flush(cls):
+        pending, cls.pending = cls.pending, []
+        for port in pending:
+            try:
+                port.flush()
+            except Exception:
+                # Flush the other ports regardless
+                logger.exception("Failed to flush %r", port)
+
+
+class BatchUdpPort(udp.Port):
+    """Twisted UDP port reading and writing datagrams in batches"""
+
+    batch_size = 32
+
+    def __init__(self, *args, **kwargs):
+        udp.Port.__init__(self, *args, **kwargs)
+        self._queue = []
+
+    def startListening(self):
+        self._recv_batch = RecvBatch(self.batch_size, self.maxPacketSize)
+        udp.Port.startListening(self)
+
+    def doRead(self):
+        try:
+            datagrams = self._recv_batch.recv(self.socket.fileno())
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR, errno.ECONNREFUSED):
+                return
+            raise
+        _Batch.depth += 1
+        try:
+            datagramReceived = self.protocol.datagramReceived
+            for datagram, addr in datagrams:
+                try:
+                    datagramReceived(datagram, addr)
+                except BaseException:
+                    log.err()
+        finally:
+            _Batch.depth -= 1
+            if not _Batch.depth:
+                _Batch.flush()
+
+    def write(self, datagram, addr=None):
+        if not _Batch.depth or addr is None:
+            return udp.Port.write(self, datagram, addr)
+        try:
+            # Reject invalid addresses now, as udp.Port.write would
+            _encode_sockaddr(self.addressFamily, *addr[:2])
+        except (OSError, TypeError, ValueError):
+            raise error.InvalidAddressError(addr[0], "invalid address for socket")
+        if not self._queue:
+            _Batch.pending.append(self)
+        # Copy, the writer may reuse its buffer before the batch is flushed
+        self._queue.append((bytes(datagram), addr))
+
+    def flush(self):
+        queue, self._queue = self._queue, []
+        if queue and self.socket:
+            sendmmsg(self.socket.fileno(), self.addressFamily, queue)
+
+
+def listen_udp(reactor, port, protocol, interface="", batch_size=32):
+    """Listen on a UDP port with batched I/O"""
+    p = BatchUdpPort(port, protocol, interface, reactor=reactor)
+    p.batch_size = batch_size
+    p.startListening()
+    return p
+
+
+def adopt_datagram_port(reactor, fd, family, protocol, batch_size=32):
+    """Listen with batched I/O on an already bound UDP socket"""
+    p = BatchUdpPort._fromListeningDescriptor(reactor, fd, family, protocol, 8192)
+    p.batch_size = batch_size
+    p.startListening()
+    return p
+
+
+def supported(reactor):
+    """Whether batched I/O can be used with `reactor`"""
+    return available and hasattr(reactor, "addReader")
@@ -1,6 +1,7 @@
 import logging
 from twisted.internet.protocol import DatagramProtocol
-from jostedal import stun
+from jostedal import stun, mmsg
+from jostedal.utils import address_cache, reuse_port_socket, PacketLog
 import struct
 import os
 import socket
@@ -10,6 +11,13 @@ logger = logging.getLogger(__name__)
 
 
 class StunUdpProtocol(DatagramProtocol):
+    # Log 1 in `log_sample_rate` received messages at INFO level
+    log_sample_rate = 1
+    # Listen with SO_REUSEPORT, letting several processes share the port
+    reuse_port = False
+    # Receive and send up to `batch_size` datagrams per system call, if > 1
+    batch_size = 0
+
     def __init__(self, reactor, interface, port, software, RTO=3.0, Rc=7, Rm=16):
         """
         :param port: UDP port to bind to
@@ -24,6 +32,8 @@ class StunUdpProtocol(DatagramProtocol):
         self.RTO = 0.5
         self.Rc = 7
         self.timeout = Rm * RTO
+        self.messages_received = 0
+        self._packet_log = PacketLog(logger, self.log_sample_rate)
 
         self._handlers = {
             # Binding handlers
@@ -36,18 +46,66 @@ class StunUdpProtocol(DatagramProtocol):
             (stun.METHOD_BINDING, stun.CLASS_RESPONSE_ERROR): self._stun_binding_error,
         }
 
-    def start(self):
-        port = self.reactor.listenUDP(self.port, self, self.interface)
+    def start(self, sock=None):
+        """
+        :param sock: bound UDP socket to listen on instead of binding one,
+            e.g. handed over by a previous server process
+        """
+        self._packet_log.update()
+        if sock is not None:
+            return self.adopt_udp(sock, self).getHost().port
+        if self.reuse_port:
+            return self._listen_reuse_port()
+        port = self.listen_udp(self.port, self)
         return port.port
 
+    def _batch_io(self):
+        return self.batch_size > 1 and mmsg.supported(self.reactor)
+
+    def listen_udp(self, port, protocol):
+        """Listen on a UDP port on this agent's interface, with batched I/O if
+        enabled and supported
+        """
+        if self._batch_io():
+            return mmsg.listen_udp(
+                self.reactor, port, protocol, self.interface, self.batch_size
+            )
+        return self.reactor.listenUDP(port, protocol, self.interface)
+
+    def adopt_udp(self, sock, protocol):
+        """Listen for `protocol` on an already bound UDP socket. The reactor
+        gets its own copy of the socket, so `sock` is closed.
+        """
+        try:
+            sock.setblocking(False)
+            if self._batch_io():
+                return mmsg.adopt_datagram_port(
+                    self.reactor, sock.fileno(), sock.family, protocol, self.batch_size
+                )
+            return self.reactor.adoptDatagramPort(sock.fileno(), sock.family, protocol)
+        finally:
+            sock.close()
+
+    def _listen_reuse_port(self):
+        """Listen on a socket bound with SO_REUSEPORT. The kernel distributes
+        datagrams between the sockets sharing the port by a hash of the
+        source and destination address over the number of sockets, so each
+        client consistently reaches the same socket as long as no socket
+        joins or leaves. `Supervisor` binds the sockets of its workers
+        itself, so restarting a worker does not move clients between them.
+        """
+        sock = reuse_port_socket(self.interface, self.port)
+        return self.adopt_udp(sock, self).getHost().port
+
     def datagramReceived(self, datagram, addr):
         msg_type = datagram[0] >> 6
         if msg_type == stun.MSG_STUN:
             try:
-                msg = Message.from_buffer(datagram)
+                msg = Message.from_buffer(datagram, lazy=True)
             except Exception:
                 logger.exception("Failed to decode STUN from %s:%d:", *addr)
-                logger.debug(datagram.hex())
+                if self._packet_log.debug_enabled:
+                    logger.debug(datagram.hex())
             else:
                 if isinstance(msg, Message):
                     self._stun_received(msg, addr)
@@ -56,24 +114,35 @@ class StunUdpProtocol(DatagramProtocol):
 
     def _stun_received(self, msg, addr):
         handler = self._handlers.get((msg.msg_method, msg.msg_class))
-        if handler:
-            logger.info("%s Received STUN", self)
-            logger.debug(msg.format())
-            try:
-                handler(msg, addr)
-            except stun.Error as stunError:
-                self.respond(stunError.create_response(msg), addr)
-        else:
-            logger.info("%s Received unrecognized STUN", self)
+        packet_log = self._packet_log
+        if packet_log.sampled(self.messages_received):
+            logger.info(
+                "%s Received %sSTUN (%d received)",
+                self,
+                "" if handler else "unrecognized ",
+                self.messages_received + 1,
+            )
+        self.messages_received += 1
+        if packet_log.debug_enabled:
             logger.debug(msg.format())
+        if handler:
+            self._dispatch(handler, msg, addr)
+
+    def _dispatch(self, handler, msg, addr):
+        try:
+            handler(msg, addr)
+        except stun.Error as stunError:
+            self.respond(stunError.create_response(msg), addr)
 
     def _stun_unhandled_datagram(self, datagram, addr):
         logger.warning("Unknown message in datagram from %s:%d:", *addr)
-        logger.debug(datagram.hex())
+        if self._packet_log.debug_enabled:
+            logger.debug(datagram.hex())
 
     def _stun_unhandled(self, msg, addr):
         logger.warning("%s Unhandeled message from %s:%d", self, *addr)
-        logger.debug(msg.format())
+        if self._packet_log.debug_enabled:
+            logger.debug(msg.format())
 
     def _stun_binding_request(self, msg, addr):
         self._stun_unhandled(msg, addr)
@@ -88,6 +157,31 @@ class StunUdpProtocol(DatagramProtocol):
         self._stun_unhandled(msg, addr)
 
 
+# Attribute padding strategies, called with the number of padding bytes needed.
+# RFC 5389 lets the padding bytes take any value, so zero bytes are sufficient.
+zero_padding = (b"", b"\x00", b"\x00\x00", b"\x00\x00\x00").__getitem__
+urandom_padding = os.urandom
+
+
+class RandomPoolPadding(object):
+    """Random padding served from a pool of random bytes, which is refilled
+    with a single `os.urandom` call when exhausted
+    """
+
+    def __init__(self, pool_size=4096):
+        self.pool_size = pool_size
+        self._pool = b""
+        self._offset = 0
+
+    def __call__(self, length):
+        offset = self._offset
+        if offset + length > len(self._pool):
+            self._pool = os.urandom(self.pool_size)
+            offset = 0
+        self._offset = offset + length
+        return self._pool[offset : offset + length]
+
+
 class Message(bytearray):
     """STUN message structure
     :see: http://tools.ietf.org/html/rfc5389#section-6
@@ -98,13 +192,29 @@ class Message(bytearray):
 
     _padding = os.urandom
 
+    # Key a request was authenticated with, which its response is signed with
+    hmac_key = None
+
     def __init__(self, data, msg_method, msg_class, magic_cookie, transaction_id):
         bytearray.__init__(self, data)
         self.msg_method = msg_method
         self.msg_class = msg_class
         self.magic_cookie = magic_cookie
         self.transaction_id = transaction_id
+        # (type, offset, length) of every attribute, in message order
+        self._attr_spans = []
+        # Decoded attributes, None until requested when lazily decoded
         self._attributes = []
+        # Attribute type to index of its first occurrence
+        self._attr_index = {}
+
+    @classmethod
+    def set_padding(cls, padding):
+        """Set the padding strategy used for attributes added to messages
+        :param padding: callable returning the given number of padding bytes,
+            e.g. `zero_padding`, `RandomPoolPadding()` or `urandom_padding`
+        """
+        cls._padding = staticmethod(padding)
 
     @classmethod
     def from_str(
@@ -125,6 +235,8 @@ class Message(bytearray):
     def add_attr(self, attr_cls, *args, **kwargs):
         attr = attr_cls.from_str(self, *args, **kwargs)
         self.extend(Attribute.struct.pack(attr.type, len(attr)))
+        self._attr_index.setdefault(attr.type, len(self._attr_spans))
+        self._attr_spans.append((attr.type, len(self), len(attr)))
         self.extend(attr)
         self.extend(self._padding(attr.padding))
         self._attributes.append(attr)
@@ -133,13 +245,58 @@ class Message(bytearray):
         return attr
 
     def get_attr(self, *attr_types):
-        for attr in self._attributes:
-            if attr.type in attr_types:
-                return attr
+        """Get the first attribute in the message of any of ``attr_types``"""
+        if len(attr_types) == 1:
+            index = self._attr_index.get(attr_types[0])
+        else:
+            indices = [
+                self._attr_index[attr_type]
+                for attr_type in attr_types
+                if attr_type in self._attr_index
+            ]
+            index = min(indices) if indices else None
+        if index is not None:
+            return self._decode_attr(index)
+
+    def get_attrs(self, *attr_types):
+        """Get the first attribute of each of ``attr_types``, None if missing"""
+        indices = [self._attr_index.get(attr_type) for attr_type in attr_types]
+        return tuple(
+            None if index is None else self._decode_attr(index) for index in indices
+        )
+
+    def _decode_attr(self, index):
+        """Get the attribute at ``index``, decoding it on first access"""
+        attr = self._attributes[index]
+        if attr is None:
+            attr_type, offset, length = self._attr_spans[index]
+            try:
+                attr = self.get_attr_cls(attr_type).from_buffer(self, offset, length)
+            except (struct.error, ValueError, OSError) as e:
+                # Any client can send these, no traceback to flood the log with
+                logger.debug("Failed to decode attribute %#06x: %s", attr_type, e)
+                raise stun.BadRequestError()
+            self._attributes[index] = attr
+        return attr
+
+    def get_attr_span(self, attr_type):
+        """(offset, length) of the value of the first attribute of
+        ``attr_type``, None if missing
+        """
+        index = self._attr_index.get(attr_type)
+        if index is not None:
+            return self._attr_spans[index][1:]
+
+    @property
+    def attributes(self):
+        """All attributes of the message, decoding any not yet decoded"""
+        return [self._decode_attr(index) for index in range(len(self._attr_spans))]
 
     @classmethod
-    def from_buffer(cls, data):
+    def from_buffer(cls, data, lazy=False):
         """
+        :param lazy: Only index the attributes, and postpone decoding of each
+            attribute until it is requested with `get_attr`
         :see: http://tools.ietf.org/html/rfc5389#section-7.3.1
         """
         assert data[0] >> 6 == stun.MSG_STUN, "Stun message MUST start with 0b00"
@@ -160,13 +317,25 @@ class Message(bytearray):
             transaction_id,
         )
         offset = cls._struct.size
-        while offset < cls._struct.size + msg_length:
-            attr_type, attr_length = Attribute.struct.unpack_from(data, offset)
+        end = offset + msg_length
+        unpack_attr_header = Attribute.struct.unpack_from
+        attr_spans = msg._attr_spans
+        attr_index = msg._attr_index
+        while offset < end:
+            attr_type, attr_length = unpack_attr_header(msg, offset)
             offset += Attribute.struct.size
-            attr = cls.get_attr_cls(attr_type).from_buffer(data, offset, attr_length)
-            msg._attributes.append(attr)
-            offset += len(attr)
-            offset += attr.padding
+            if attr_type not in attr_index:
+                attr_index[attr_type] = len(attr_spans)
+            attr_spans.append((attr_type, offset, attr_length))
+            # value is padded to a 4 byte boundary
+            offset += attr_length + (-attr_length % 4)
+        if lazy:
+            msg._attributes = [None] * len(msg._attr_spans)
+        else:
+            msg._attributes = [
+                cls.get_attr_cls(attr_type).from_buffer(msg, offset, attr_length)
+                for attr_type, offset, attr_length in msg._attr_spans
+            ]
         return msg
 
     @classmethod
@@ -188,10 +357,13 @@ class Message(bytearray):
 
     def unknown_comp_required_attrs(self, ignored=()):
         """Returns a list of unknown comprehension-required attributes"""
+        # Resolved from the attribute types alone, no attribute is decoded
         return tuple(
-            attr.type
-            for attr in self._attributes
-            if attr.type not in ignored and attr.required and isinstance(attr, Unknown)
+            attr_type
+            for attr_type, _offset, _length in self._attr_spans
+            if attr_type not in ignored
+            and attr_type < 0x8000
+            and issubclass(self.get_attr_cls(attr_type), Unknown)
         )
 
     @property
@@ -209,9 +381,11 @@ class Message(bytearray):
         return attr_cls.__name__ if attr_cls else "{:#06x}".format(attr_type)
 
     def create_response(self, msg_class):
-        return self.from_str(
+        response = self.from_str(
             self.msg_method, msg_class, self.magic_cookie, self.transaction_id
         )
+        response.hmac_key = self.hmac_key
+        return response
 
     def __repr__(self):
         return (
@@ -223,7 +397,7 @@ class Message(bytearray):
                 len(self) - self._struct.size,
                 self.magic_cookie,
                 self.transaction_id.hex(),
-                self._attributes,
+                self.attributes,
             )
         )
 
@@ -240,9 +414,19 @@ class Message(bytearray):
                 "",
             ]
         ).format(self, self.transaction_id.hex())
-        string += "\n".join(["    \t" + repr(attr) for attr in self._attributes])
+        string += "\n".join(
+            "    \t" + self._format_attr(index)
+            for index in range(len(self._attr_spans))
+        )
         return string
 
+    def _format_attr(self, index):
+        try:
+            return repr(self._decode_attr(index))
+        except stun.BadRequestError:
+            attr_type, _offset, length = self._attr_spans[index]
+            return "<malformed attribute {:#06x}, {} bytes>".format(attr_type, length)
+
 
 class Attribute(bytes):
     """STUN message attribute structure
@@ -293,6 +477,12 @@ class Address(Attribute):
     :cvar _xored: Wether or not the port and address field are xored
     """
 
+    # IPv4 addresses are xored with the magic cookie as one 32-bit word, IPv6
+    # addresses with the magic cookie and transaction id as two 64-bit words
+    _magic_struct = struct.Struct(">H")
+    _ipv4_struct = struct.Struct(">L")
+    _ipv6_struct = struct.Struct(">2Q")
+
     struct = struct.Struct(">xBH")
 
     FAMILY_IPv4 = 0x01
@@ -303,35 +493,59 @@ class Address(Attribute):
 
     _xored = False
 
-    def __init__(self, data, family, port, address):
+    def __init__(self, data, family, port, address, packed_ip=None):
         self.family = family
         self.port = port
         self.address = address
+        self.packed_ip = packed_ip
+
+    @classmethod
+    def _xor_port(cls, msg, port):
+        """XOR a port with the most significant 16 bits of the magic cookie"""
+        return port ^ cls._magic_struct.unpack_from(msg, 4)[0]
+
+    @classmethod
+    def _xor_packed_ip(cls, msg, buffer, offset, length):
+        """XOR the packed IP address found at `offset` in `buffer` with the
+        concatination of the magic cookie and the transaction id (msg[4:20])
+        """
+        if length == 4:
+            (ip,) = cls._ipv4_struct.unpack_from(buffer, offset)
+            (magic,) = cls._ipv4_struct.unpack_from(msg, 4)
+            return cls._ipv4_struct.pack(ip ^ magic)
+        elif length == 16:
+            ip_high, ip_low = cls._ipv6_struct.unpack_from(buffer, offset)
+            magic_high, magic_low = cls._ipv6_struct.unpack_from(msg, 4)
+            return cls._ipv6_struct.pack(ip_high ^ magic_high, ip_low ^ magic_low)
+        raise ValueError("Invalid address length {}".format(length))
 
     @classmethod
     def from_buffer(cls, data, offset, length):
         family, port = cls.struct.unpack_from(data, offset)
-        packed_ip = memoryview(data)[offset + cls.struct.size : offset + length]
+        ip_offset = offset + cls.struct.size
+        ip_length = length - cls.struct.size
         if cls._xored:
-            # xport and xaddress are xored with the concatination of
-            # the magic cookie and the transaction id (data[4:20])
-            magic = bytearray(*struct.unpack_from(">16s", data, 4))
-            port = port ^ magic[0] << 8 ^ magic[1]
-            packed_ip = memoryview(bytearray(a ^ b for a, b in zip(packed_ip, magic)))
-        address = socket.inet_ntop(Address.ftoaf(family), packed_ip)
+            port = cls._xor_port(data, port)
+            packed_ip = cls._xor_packed_ip(data, data, ip_offset, ip_length)
+        else:
+            packed_ip = bytes(data[ip_offset : ip_offset + ip_length])
+        af = Address.ftoaf(family)
+        if af is None:
+            raise ValueError("Unknown address family {:#04x}".format(family))
+        address = address_cache.ntop(af, packed_ip)
         value = memoryview(data)[offset : offset + length]
-        return cls(value, family, port, address)
+        return cls(value, family, port, address, packed_ip)
 
     @classmethod
     def from_str(cls, msg, family, port, address):
-        xport = port
-        packed_ip = socket.inet_pton(Address.ftoaf(family), address)
+        packed_ip = address_cache.pton(Address.ftoaf(family), address)
         if cls._xored:
-            magic = bytearray(*struct.unpack_from(">16s", msg, 4))
-            xport = port ^ magic[0] << 8 ^ magic[1]
-            packed_ip = bytearray(a ^ b for a, b in zip(packed_ip, magic))
-        data = cls.struct.pack(family, xport) + packed_ip
-        return cls(data, family, port, address)
+            xport = cls._xor_port(msg, port)
+            xpacked_ip = cls._xor_packed_ip(msg, packed_ip, 0, len(packed_ip))
+            data = cls.struct.pack(family, xport) + xpacked_ip
+        else:
+            data = cls.struct.pack(family, port) + packed_ip
+        return cls(data, family, port, address, packed_ip)
 
     def __repr__(self):
         return "{}(family={:#04x}, port={}, address={!r})".format(
@@ -1,4 +1,4 @@
-from jostedal.stun.agent import attribute, Address, Attribute
+from jostedal.stun.agent import attribute, Address, Attribute, Message
 from jostedal import stun
 import struct
 import hmac
@@ -40,17 +40,61 @@ class MessageIntegrity(Attribute):
 
     type = stun.ATTR_MESSAGE_INTEGRITY
     _struct = struct.Struct("20s")
+    _length_struct = struct.Struct(">H")
 
     @classmethod
     def from_str(cls, msg, key):
         """
-        :param key: H(A1) for long-term, SASLprep(password) for short-term auth
+        :param key: H(A1) for long-term, SASLprep(password) for short-term auth,
+            or a key prepared with `prepare_key`
         """
         # HMAC covers the 'length' value of msg, so it needs to be updated first
         msg.length += cls._struct.size + Attribute.struct.size
 
-        value = hmac.new(key, msg, hashlib.sha1).digest()
-        return cls(value)
+        return cls(cls.compute(key, msg))
+
+    @staticmethod
+    def prepare_key(key):
+        """HMAC-SHA1 object keyed with `key`, for `compute` to copy rather
+        than derive the inner and outer pads of the key for every message
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        return hmac.new(key, digestmod=hashlib.sha1)
+
+    @classmethod
+    def compute(cls, key, data):
+        """HMAC-SHA1 of `data`
+        :param key: key as bytes, or prepared with `prepare_key`
+        """
+        if isinstance(key, hmac.HMAC):
+            mac = key.copy()
+        else:
+            mac = cls.prepare_key(key)
+        mac.update(data)
+        return mac.digest()
+
+    @classmethod
+    def verify(cls, msg, key):
+        """Whether the MESSAGE-INTEGRITY of the received `msg` was computed
+        with `key`. The HMAC covers the message up to the attribute, with the
+        length in the header as if the attribute were the last one; the
+        length is fed to the HMAC separately rather than patched in a copy.
+        :param key: key as bytes, or prepared with `prepare_key`
+        """
+        span = msg.get_attr_span(cls.type)
+        if not span or span[1] != cls._struct.size:
+            return False
+        offset, length = span
+        if isinstance(key, hmac.HMAC):
+            mac = key.copy()
+        else:
+            mac = cls.prepare_key(key)
+        with memoryview(msg) as view:
+            mac.update(view[:2])
+            mac.update(cls._length_struct.pack(offset + length - Message._struct.size))
+            mac.update(view[4 : offset - Attribute.struct.size])
+            return hmac.compare_digest(mac.digest(), view[offset : offset + length])
 
     def __repr__(self):
         return f"MESSAGE-INTEGRITY({self.hex()})"
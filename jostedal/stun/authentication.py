@@ -1,13 +1,16 @@
 from jostedal import stun
 from jostedal.utils import saslprep, ha1
 from jostedal.stun import attributes
+from jostedal.stun.credentials import CredentialCache
 
+import collections
 import os
 import logging
 from datetime import datetime
 import hashlib
 import hmac
 import base64
+import struct
 import time
 
 
@@ -15,7 +18,7 @@ logger = logging.getLogger(__name__)
 
 
 class CredentialMechanism(object):
-    def update(self, message):
+    def update(self, message, addr=None):
         pass
 
 
@@ -27,47 +30,149 @@ class ShortTermCredentialMechanism(CredentialMechanism):
     def __init__(self, username, password):
         self.username = username
         self.hmac_key = saslprep(password)
+        self._prepared_key = attributes.MessageIntegrity.prepare_key(self.hmac_key)
 
-    def update(self, msg):
+    def update(self, msg, addr=None):
         msg.add_attr(attributes.Username, self.username)
-        msg.add_attr(attributes.MessageIntegrity, self.hmac_key)
+        msg.add_attr(attributes.MessageIntegrity, self._prepared_key)
 
 
 class LongTermCredentialMechanism(CredentialMechanism):
     """
+    Nonces are stateless: the time they were issued and an HMAC of that time
+    and the client address, with a server key rotated every
+    `nonce_key_interval` seconds. Servers configured with the same
+    `nonce_secret` accept each other's nonces.
+
+    Users not in `users` are looked up with `provider`, if given, and cached
+    in `credentials`.
     :see: http://tools.ietf.org/html/rfc5389#section-10.2
     """
 
-    def __init__(self, realm, users={}):
-        self.nonce = self.generate_nonce()
+    nonce_lifetime = 3600
+    nonce_key_interval = 3600
+    _nonce_struct = struct.Struct(">L10s")
+
+    def __init__(self, realm, users={}, nonce_secret=None, provider=None):
+        if isinstance(nonce_secret, str):
+            nonce_secret = nonce_secret.encode()
+        self.nonce_secret = nonce_secret or os.urandom(32)
+        self._nonce_keys = {}
         self.realm = realm
         self.hmac_keys = {}
+        # HMAC objects prepared with each key in hmac_keys
+        self._prepared_keys = {}
         for username, credentials in users.items():
-            password = credentials.get("password")
-            if not password:
+            key = self._credentials_key(username, credentials)
+            if not key:
                 logger.warning("Invalid credentials for %s", username)
                 continue
 
-            self.add_user(username, password)
+            self.add_key(username, key)
+        self.credentials = None
+        if provider:
+            self.credentials = CredentialCache(provider, self._derive_key)
 
     def add_user(self, username, password):
-        self.hmac_keys[username] = ha1(username, self.realm, password)
-
-    def generate_nonce(self, length=16):
-        return os.urandom(length // 2).hex()
-
-    def authenticate(self, msg):
-        realm = msg.get_attr(stun.ATTR_REALM)
-        username = msg.get_attr(stun.ATTR_USERNAME)
-        nonce = msg.get_attr(stun.ATTR_NONCE)
-        message_integrity = msg.get_attr(stun.ATTR_MESSAGE_INTEGRITY)
+        self.add_key(username, ha1(username, self.realm, password))
+
+    def add_key(self, username, key):
+        """Add a user by its long-term key, H(A1)"""
+        self.hmac_keys[username] = key
+        self._prepared_keys[username] = attributes.MessageIntegrity.prepare_key(key)
+
+    def _credentials_key(self, username, credentials):
+        """Long-term key from {"password": ...} or {"key": <hex H(A1)>}"""
+        password = credentials.get("password")
+        if password:
+            return ha1(username, self.realm, password)
+        try:
+            return bytes.fromhex(credentials.get("key") or "") or None
+        except ValueError:
+            return None
+
+    def _derive_key(self, username, credentials):
+        key = self._credentials_key(username, credentials)
+        return key and attributes.MessageIntegrity.prepare_key(key)
+
+    def get_key(self, username):
+        """Long-term key of `username`, prepared for MESSAGE-INTEGRITY, or
+        None for an unknown user
+        :raises CredentialsPending: if the user is being looked up
+        """
+        key = self._prepared_keys.get(username)
+        if key is None and self.credentials is not None:
+            key = self.credentials.get(username)
+        return key
+
+    def generate_nonce(self, addr):
+        """Nonce for the client at `addr`, issued now"""
+        timestamp = int(time.time())
+        return self._nonce_struct.pack(
+            timestamp, self._nonce_signature(timestamp, addr)
+        ).hex()
+
+    def _nonce_signature(self, timestamp, addr):
+        epoch = timestamp // self.nonce_key_interval
+        key = self._nonce_keys.get(epoch)
+        if not key:
+            # Keep the keys of the current and the previous epoch
+            for old_epoch in [e for e in self._nonce_keys if e < epoch - 1]:
+                del self._nonce_keys[old_epoch]
+            key = self._nonce_keys[epoch] = attributes.MessageIntegrity.prepare_key(
+                hmac.digest(self.nonce_secret, str(epoch).encode(), hashlib.sha1)
+            )
+        mac = key.copy()
+        mac.update("{}:{}:{}".format(timestamp, *addr[:2]).encode())
+        return mac.digest()[: self._nonce_struct.size - 4]
+
+    def _valid_nonce(self, nonce, addr):
+        try:
+            timestamp, signature = self._nonce_struct.unpack(bytes.fromhex(nonce))
+        except (ValueError, struct.error):
+            return False
+        if not 0 <= time.time() - timestamp < self.nonce_lifetime:
+            return False
+        return hmac.compare_digest(signature, self._nonce_signature(timestamp, addr))
+
+    def authenticate(self, msg, addr):
+        realm, username, nonce, message_integrity = msg.get_attrs(
+            stun.ATTR_REALM,
+            stun.ATTR_USERNAME,
+            stun.ATTR_NONCE,
+            stun.ATTR_MESSAGE_INTEGRITY,
+        )
         if not (realm and username and nonce and message_integrity):
             raise stun.UnauthorizedError()
-
-    def update(self, msg):
-        msg.add_attr(attributes.Nonce, self.nonce.encode())
-        msg.add_attr(attributes.Realm, self.realm.encode())
-        msg.add_attr(attributes.MessageIntegrity, list(self.hmac_keys.values())[0])
+        try:
+            key = self.get_key(bytes(username).decode("utf8"))
+        except UnicodeDecodeError:
+            key = None
+        if (
+            not key
+            or bytes(realm) != self.realm.encode()
+            or not attributes.MessageIntegrity.verify(msg, key)
+        ):
+            raise stun.UnauthorizedError()
+        # Checked after the message integrity, see RFC 5389 section 10.2.2
+        try:
+            nonce = bytes(nonce).decode("ascii")
+        except UnicodeDecodeError:
+            raise stun.StaleNonceError()
+        if not self._valid_nonce(nonce, addr):
+            raise stun.StaleNonceError()
+        msg.hmac_key = key
+
+    def update(self, msg, addr=None):
+        """Sign responses to authenticated requests, and challenge the client
+        at `addr` with REALM and NONCE otherwise
+        :see: http://tools.ietf.org/html/rfc5389#section-10.2.2
+        """
+        if msg.hmac_key:
+            msg.add_attr(attributes.MessageIntegrity, msg.hmac_key)
+        else:
+            msg.add_attr(attributes.Nonce, self.generate_nonce(addr).encode())
+            msg.add_attr(attributes.Realm, self.realm.encode())
 
     def __str__(self):
         return "realm={}".format(self.realm)
@@ -81,16 +186,54 @@ class TimeLimitedCredentialMechanism(LongTermCredentialMechanism):
     :see: "TURN REST API" section at https://github.com/coturn/coturn/blob/master/README.turnserver
     """
 
-    def __init__(self, realm, shared_secret):
-        super().__init__(realm)
+    def __init__(
+        self,
+        realm,
+        shared_secret,
+        users={},
+        nonce_secret=None,
+        cache_size=65536,
+        provider=None,
+    ):
+        super().__init__(realm, users, nonce_secret, provider)
         self.shared_secret = shared_secret
+        self.cache_size = cache_size
+        # Username to (expiry, prepared key), least recently used first
+        self._key_cache = collections.OrderedDict()
 
     def generate_credentials(self, username, time_to_expiry=600):
         username = f"{int(time.time()) + time_to_expiry}:{username}"
+        return username, self._password(username)
+
+    def _password(self, username):
         password_bytes = hmac.digest(self.shared_secret.encode(), username.encode(), hashlib.sha1)
-        password = base64.b64encode(password_bytes).decode()
-        self.add_user(username, password)
-        return username, password
+        return base64.b64encode(password_bytes).decode()
+
+    def get_key(self, username):
+        """Derive the key of an `expiry:username` from the shared secret,
+        memoized until the expiry
+        """
+        entry = self._key_cache.get(username)
+        if entry:
+            if entry[0] > time.time():
+                self._key_cache.move_to_end(username)
+                return entry[1]
+            del self._key_cache[username]
+            return None
+        expiry, _sep, _name = username.partition(":")
+        try:
+            expiry = int(expiry)
+        except ValueError:
+            return super().get_key(username)
+        if expiry <= time.time():
+            return None
+        key = attributes.MessageIntegrity.prepare_key(
+            ha1(username, self.realm, self._password(username))
+        )
+        self._key_cache[username] = (expiry, key)
+        if len(self._key_cache) > self.cache_size:
+            self._key_cache.popitem(last=False)
+        return key
 
     def __repr__(self, *args, **kwargs):
         return "TimeLimitedCredentialMechanism({})".format(self)
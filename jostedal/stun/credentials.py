@@ -0,0 +1,190 @@
+"""Credential providers, looking up long-term credentials of users outside of
+the reactor thread
+
+Providers resolve a username to its credentials in the form used by the
+`users` of the config file, ``{"password": ...}`` or ``{"key": <hex H(A1)>}``,
+or None for an unknown user. `LongTermCredentialMechanism` caches the keys
+derived from the credentials with a `CredentialCache`.
+"""
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from twisted.internet import defer, threads
+
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialsPending(Exception):
+    """Raised while the credentials of a request are being looked up. The
+    request should be handled again when `deferred` fires.
+    """
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+
+
+class CredentialProvider(object):
+    def lookup(self, username):
+        """
+        :returns: Deferred firing with the credentials of `username`, or None
+        """
+        raise NotImplementedError()
+
+
+class ThreadedCredentialProvider(CredentialProvider):
+    """Provider doing blocking lookups in the reactor's thread pool"""
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def lookup(self, username):
+        return threads.deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), self._lookup, username
+        )
+
+    def _lookup(self, username):
+        raise NotImplementedError()
+
+
+class FileCredentialProvider(ThreadedCredentialProvider):
+    """Users in a JSON file, in the format of `users` in the config file. The
+    file is read again when it has been modified.
+    """
+
+    def __init__(self, reactor, path):
+        ThreadedCredentialProvider.__init__(self, reactor)
+        self.path = path
+        self._users = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _lookup(self, username):
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self._mtime:
+                with open(self.path) as fp:
+                    self._users = json.load(fp)
+                self._mtime = mtime
+            return self._users.get(username)
+
+
+class SqliteCredentialProvider(ThreadedCredentialProvider):
+    """Users in an SQLite database
+    :param query: query selecting the password and key of the username
+    """
+
+    query = "SELECT password, key FROM users WHERE username = ?"
+
+    def __init__(self, reactor, path, query=None):
+        ThreadedCredentialProvider.__init__(self, reactor)
+        self.path = path
+        self.query = query or self.query
+        # sqlite3 connections can only be used by the thread creating them
+        self._local = threading.local()
+
+    def _lookup(self, username):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        row = connection.execute(self.query, (username,)).fetchone()
+        if not row:
+            return None
+        password, key = row
+        return {"password": password} if password else {"key": key}
+
+
+class HttpCredentialProvider(ThreadedCredentialProvider):
+    """Users looked up with a GET request, answered with the credentials as a
+    JSON object, or 404 Not Found for an unknown user
+    :param url: URL with a ``{username}`` placeholder
+    """
+
+    timeout = 5
+
+    def __init__(self, reactor, url):
+        ThreadedCredentialProvider.__init__(self, reactor)
+        self.url = url
+
+    def _lookup(self, username):
+        url = self.url.format(username=urllib.parse.quote(username, safe=""))
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+
+class CredentialCache(object):
+    """Keys of users looked up with a provider, cached for `ttl` seconds, and
+    unknown users for `negative_ttl` seconds. Concurrent requests for a
+    username not in the cache share one lookup.
+    :param provider: `CredentialProvider`
+    :param derive: callable(username, credentials) returning the key to cache,
+        or None for invalid credentials
+    """
+
+    def __init__(self, provider, derive, ttl=300, negative_ttl=30, maxsize=65536):
+        self.provider = provider
+        self.derive = derive
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        # Username to (expiry, key or None), least recently used first
+        self._entries = collections.OrderedDict()
+        # Username to Deferreds waiting for its lookup
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, username):
+        """Cached key of `username`, None if unknown
+        :raises CredentialsPending: if `username` is being looked up
+        """
+        entry = self._entries.get(username)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(username)
+            return entry[1]
+        waiter = defer.Deferred()
+        waiters = self._pending.get(username)
+        if waiters is None:
+            waiters = self._pending[username] = [waiter]
+            d = self.provider.lookup(username)
+            d.addCallback(self._found, username)
+            d.addErrback(self._failed, username)
+        else:
+            waiters.append(waiter)
+        if waiter.called:
+            # Looked up synchronously
+            return self._entries[username][1]
+        raise CredentialsPending(waiter)
+
+    def _found(self, credentials, username):
+        key = self.derive(username, credentials) if credentials else None
+        self._cache(username, key)
+
+    def _failed(self, failure, username):
+        logger.warning(
+            "Credentials lookup for %s failed: %s", username, failure.getErrorMessage()
+        )
+        self._cache(username, None)
+
+    def _cache(self, username, key):
+        ttl = self.ttl if key else self.negative_ttl
+        self._entries.pop(username, None)
+        self._entries[username] = (time.time() + ttl, key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        for waiter in self._pending.pop(username, ()):
+            waiter.callback(key)
@@ -1,43 +1,170 @@
+import collections
 import logging
+import struct
+import binascii
 from jostedal.stun.agent import StunUdpProtocol
 from jostedal.stun import attributes
 from jostedal import stun
-from jostedal.stun.agent import Message, Address
+from jostedal.utils import address_cache, PacketLog
+from jostedal.stun.agent import Message, Address, Attribute, zero_padding
 
 logger = logging.getLogger(__name__)
 
 
+class BindingResponseTemplate(object):
+    """Pre-serialized Binding success response with XOR-MAPPED-ADDRESS,
+    SOFTWARE and FINGERPRINT attributes. Only the transaction id, the mapped
+    address and the fingerprint are written into the buffer per response.
+    """
+
+    _port_struct = struct.Struct(">H")
+
+    def __init__(self, family, software):
+        self.family = family
+        self._af = Address.ftoaf(family)
+        response = Message.from_str(
+            stun.METHOD_BINDING,
+            stun.CLASS_RESPONSE_SUCCESS,
+            transaction_id=bytes(12),
+        )
+        response._padding = zero_padding
+        unspecified = "0.0.0.0" if family == Address.FAMILY_IPv4 else "::"
+        response.add_attr(attributes.XorMappedAddress, family, 0, unspecified)
+        response.add_attr(attributes.Software, software)
+        response.add_attr(attributes.Fingerprint)
+
+        (_, address_offset, _), _, (_, fingerprint_offset, _) = response._attr_spans
+        self._port_offset = address_offset + 2
+        self._ip_offset = address_offset + Address.struct.size
+        self._fingerprint_offset = fingerprint_offset
+        self.buffer = bytearray(response)
+
+    def render(self, transaction_id, port, host):
+        """Write a response for the given transaction and mapped address into
+        the template buffer, and return the buffer
+        """
+        buf = self.buffer
+        buf[8:20] = transaction_id
+        packed_ip = address_cache.pton(self._af, host)
+        ip_length = len(packed_ip)
+        xport = Address._xor_port(buf, port)
+        self._port_struct.pack_into(buf, self._port_offset, xport)
+        buf[self._ip_offset : self._ip_offset + ip_length] = Address._xor_packed_ip(
+            buf, packed_ip, 0, ip_length
+        )
+        crc = binascii.crc32(
+            memoryview(buf)[: self._fingerprint_offset - Attribute.struct.size]
+        )
+        attributes.Fingerprint._struct.pack_into(
+            buf,
+            self._fingerprint_offset,
+            (crc & 0xFFFFFFFF) ^ attributes.Fingerprint._MAGIC,
+        )
+        return buf
+
+
+class ResponseCache(object):
+    """Serialized responses by (client address, transaction id), to answer
+    retransmitted requests without processing them again. Entries are kept
+    in insertion order, so expired entries are dropped from the front.
+    :see: http://tools.ietf.org/html/rfc5389#section-7.3.1
+    :param clock: provider of `seconds`, e.g. the reactor
+    :param timeout: seconds to keep a response
+    :param maxsize: maximum number of responses kept
+    """
+
+    def __init__(self, clock, timeout=40, maxsize=65536):
+        self.clock = clock
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, addr, transaction_id):
+        entry = self._entries.get((addr, transaction_id))
+        if entry and entry[0] > self.clock.seconds():
+            return entry[1]
+        return None
+
+    def add(self, addr, transaction_id, response):
+        now = self.clock.seconds()
+        entries = self._entries
+        while entries:
+            expiry, _response = next(iter(entries.values()))
+            if expiry > now and len(entries) < self.maxsize:
+                break
+            entries.popitem(last=False)
+        key = (addr, transaction_id)
+        if key in entries:
+            # Keep the first response, later ones answer retransmissions
+            return
+        entries[key] = (now + self.timeout, bytes(response))
+
+
 class StunUdpServer(StunUdpProtocol):
+    # Retransmissions of a request within `transaction_timeout` seconds get
+    # the cached response
+    transaction_timeout = 40
+    response_cache_size = 65536
+
     def __init__(self, reactor, interface, port, software, overrides={}):
         StunUdpProtocol.__init__(self, reactor, interface, port, software)
         self.overrides = overrides
+        self._binding_templates = {}
+        self._responses = ResponseCache(
+            reactor, self.transaction_timeout, self.response_cache_size
+        )
+        self.responses_sent = 0
+        self._response_log = PacketLog(logger, self.log_sample_rate)
+
+    def start(self, sock=None):
+        self._response_log.update()
+        return StunUdpProtocol.start(self, sock)
+
+    def datagramReceived(self, datagram, addr):
+        # Requests have the class bits, 0x0110 of the message type, cleared
+        if len(datagram) >= 20 and not datagram[0] & 0xC1 and not datagram[1] & 0x10:
+            response = self._responses.get(addr, bytes(datagram[8:20]))
+            if response:
+                self.transport.write(response, addr)
+                if self._response_log.sampled(self.responses_sent):
+                    logger.info("%s Resending response", self)
+                self.responses_sent += 1
+                return
+        StunUdpProtocol.datagramReceived(self, datagram, addr)
 
     def respond(self, response, addr):
         response.add_attr(attributes.Software, self.software)
-        self.credential_mechanism.update(response)
+        self.credential_mechanism.update(response, addr)
         response.add_attr(attributes.Fingerprint)
+        self._responses.add(addr, response.transaction_id, response)
         self.transport.write(response, addr)
-        logger.info("%s Sending response", self)
-        logger.debug(response.format())
+        response_log = self._response_log
+        if response_log.sampled(self.responses_sent):
+            logger.info(
+                "%s Sending response (%d sent)", self, self.responses_sent + 1
+            )
+        self.responses_sent += 1
+        if response_log.debug_enabled:
+            logger.debug(response.format())
 
     def _stun_binding_request(self, msg, addr):
-        if msg.msg_class == stun.CLASS_REQUEST:
-            unknown_attributes = msg.unknown_comp_required_attrs()
-            if unknown_attributes:
-                raise stun.UnknownAttributeError(unknown_attributes)
-            else:
-                response = Message.from_str(
-                    stun.METHOD_BINDING,
-                    stun.CLASS_RESPONSE_SUCCESS,
-                    transaction_id=msg.transaction_id,
-                )
-                family = Address.aftof(self.transport.addressFamily)
-                host, port = self.overrides.get("mapped_address", addr)
-                response.add_attr(attributes.XorMappedAddress, family, port, host)
-                response.add_attr(attributes.Software, self.software)
+        unknown_attributes = msg.unknown_comp_required_attrs()
+        if unknown_attributes:
+            raise stun.UnknownAttributeError(unknown_attributes)
+        family = Address.aftof(self.transport.addressFamily)
+        template = self._binding_templates.get(family)
+        if not template:
+            template = BindingResponseTemplate(family, self.software)
+            self._binding_templates[family] = template
+        host, port = self.overrides.get("mapped_address", addr)
+        response = template.render(msg.transaction_id, port, host)
         self.transport.write(response, addr)
-        logger.info("%s Sending response", self)
-        logger.debug(response.format())
+        self.responses_sent += 1
+        if self._response_log.debug_enabled:
+            logger.debug(Message.from_buffer(response).format())
 
     def _stun_binding_indication(self, msg, addr):
         pass
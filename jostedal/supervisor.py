@@ -0,0 +1,210 @@
+"""Pre-forking supervisor for running a server in several worker processes,
+each listening on the same UDP port with SO_REUSEPORT
+
+The kernel picks the socket for a datagram by a hash of its addresses over
+the number of sockets in the port's reuseport group, so a socket leaving the
+group moves clients of all the workers to other workers. The supervisor
+binds the socket of each worker before forking and keeps it open, so the
+group does not change when a worker is restarted. Datagrams for a worker
+that is down wait in its socket's buffer until it is restarted.
+"""
+
+import os
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import logging
+from twisted.internet import protocol
+from jostedal.utils import reuse_port_socket
+
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    """Forks and restarts worker processes, and serves the aggregated stats
+    of the workers on a local control socket
+
+    Workers must not share a reactor with the supervisor, so the reactor is
+    imported by `worker_main` after the fork.
+
+    :param workers: number of worker processes
+    :param worker_main: callable(index) running worker `index` until it exits
+    :param control_path: path of the Unix control socket, each worker serves
+        its own stats on `control_path.<index>` (see `listen_stats`)
+    :param address: (interface, port) to bind a SO_REUSEPORT socket to for
+        each worker, which listens on `worker_socket(index)`
+    """
+
+    restart_delay = 1.0
+    control_timeout = 1.0
+
+    def __init__(self, workers, worker_main, control_path=None, address=None):
+        self.workers = workers
+        self.worker_main = worker_main
+        self.control_path = control_path
+        self.address = address
+        self._sockets = []  # Socket of each worker, by index
+        self._pids = {}  # pid to worker index
+        self._running = False
+
+    def worker_control_path(self, index):
+        return "{}.{}".format(self.control_path, index)
+
+    def worker_socket(self, index):
+        """Copy of the socket of worker `index`, to be called in the worker"""
+        return self._sockets[index].dup()
+
+    def _bind_sockets(self):
+        interface, port = self.address
+        while len(self._sockets) < self.workers:
+            sock = reuse_port_socket(interface, port)
+            # Bind the other sockets to the port picked for the first
+            port = sock.getsockname()[1]
+            self._sockets.append(sock)
+
+    def run(self):
+        self._running = True
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        signal.signal(signal.SIGHUP, self._reload)
+        if self.address:
+            self._bind_sockets()
+        for index in range(self.workers):
+            self._spawn(index)
+        control = self._listen_control() if self.control_path else None
+        try:
+            while self._running:
+                self._reap()
+                readable, _, _ = select.select([control] if control else [], [], [], 1)
+                if readable:
+                    self._serve_control(control)
+        finally:
+            if control:
+                control.close()
+                os.unlink(self.control_path)
+            self._stop_workers()
+            for sock in self._sockets:
+                sock.close()
+
+    def _terminate(self, signum, frame):
+        self._running = False
+
+    def _reload(self, signum, frame):
+        """Pass SIGHUP on to the workers, to reload their config"""
+        logger.info("Reloading workers")
+        self._signal_workers(signal.SIGHUP)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # Ignored until the worker installs its reload handler
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            for other, sock in enumerate(self._sockets):
+                if other != index:
+                    sock.close()
+            status = 0
+            try:
+                self.worker_main(index)
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+                status = 1
+            finally:
+                os._exit(status)
+        logger.info("Started worker %d (pid %d)", index, pid)
+        self._pids[pid] = index
+
+    def _reap(self):
+        while self._pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            index = self._pids.pop(pid)
+            if self._running:
+                logger.warning(
+                    "Worker %d (pid %d) exited with status %d, restarting",
+                    index,
+                    pid,
+                    status,
+                )
+                time.sleep(self.restart_delay)
+                self._spawn(index)
+
+    def _signal_workers(self, signum):
+        for pid in self._pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _stop_workers(self):
+        self._signal_workers(signal.SIGTERM)
+        for pid in list(self._pids):
+            os.waitpid(pid, 0)
+            del self._pids[pid]
+
+    def _listen_control(self):
+        if os.path.exists(self.control_path):
+            os.unlink(self.control_path)
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.bind(self.control_path)
+        control.listen()
+        return control
+
+    def _serve_control(self, control):
+        conn, _ = control.accept()
+        with conn:
+            conn.settimeout(self.control_timeout)
+            try:
+                conn.sendall(json.dumps(self.stats()).encode() + b"\n")
+            except OSError:
+                logger.exception("Failed to send stats")
+
+    def stats(self):
+        """Stats of each worker and the totals over all workers"""
+        workers = [self._worker_stats(index) for index in range(self.workers)]
+        total = {}
+        for stats in workers:
+            for key, value in (stats or {}).items():
+                total[key] = total.get(key, 0) + value
+        return {"total": total, "workers": workers}
+
+    def _worker_stats(self, index):
+        data = b""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.control_timeout)
+                sock.connect(self.worker_control_path(index))
+                while True:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+            return json.loads(data)
+        except (OSError, ValueError):
+            logger.warning("No stats from worker %d", index)
+            return None
+
+
+class StatsProtocol(protocol.Protocol):
+    """Writes the stats of the factory's server as JSON, then disconnects"""
+
+    def connectionMade(self):
+        stats = self.factory.server.stats()
+        self.transport.write(json.dumps(stats).encode() + b"\n")
+        self.transport.loseConnection()
+
+
+def listen_stats(reactor, path, server):
+    """Serve `server.stats()` on a Unix socket at `path`"""
+    if os.path.exists(path):
+        os.unlink(path)
+    factory = protocol.Factory.forProtocol(StatsProtocol)
+    factory.server = server
+    return reactor.listenUNIX(path, factory)
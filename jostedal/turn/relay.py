@@ -1,8 +1,12 @@
 from twisted.internet.protocol import DatagramProtocol
 from jostedal.stun.agent import Address, Message
+import collections
 import logging
+import random
+import socket
 from jostedal import stun, turn
 from jostedal.turn import attributes
+from jostedal.utils import PacketLog
 
 
 logger = logging.getLogger(__name__)
@@ -26,6 +30,16 @@ class ChannelMessage(bytearray):
         message.extend(data)
         return message
 
+    @classmethod
+    def encode_into(cls, buffer, channel_number, data):
+        """Write a channel message into `buffer`, a writable memoryview
+        :returns: the size of the channel message
+        """
+        size = cls._struct.size + len(data)
+        cls._struct.pack_into(buffer, 0, channel_number, len(data))
+        buffer[cls._struct.size : size] = data
+        return size
+
     @classmethod
     def decode(cls, data):
         assert data[0] >> 6 == turn.MSG_CHANNEL, \
@@ -48,63 +62,371 @@ class ChannelMessage(bytearray):
             ]).format(self)
         return string
 
+class PermissionTable(object):
+    """Permissions installed on a relay, mapping peer IP address to the
+    time the permission expires. Expired permissions are removed by the
+    server's timer wheel.
+    :see: http://tools.ietf.org/html/rfc5766#section-8
+    """
+
+    lifetime = 300
+
+    def __init__(self, timer_wheel):
+        self._timer_wheel = timer_wheel
+        self._expiries = {}
+
+    def add(self, host, lifetime=None):
+        """Install or refresh the permission for `host`"""
+        expiry = self._timer_wheel.clock.seconds() + (lifetime or self.lifetime)
+        if host not in self._expiries:
+            self._timer_wheel.schedule(expiry, self._expire, host)
+        self._expiries[host] = expiry
+
+    def _expire(self, host):
+        expiry = self._expiries.get(host)
+        if expiry is not None and self._timer_wheel.due(expiry, self._expire, host):
+            del self._expiries[host]
+            logger.info("Permission for %s expired", host)
+
+    def clear(self):
+        self._expiries.clear()
+
+    def expiries(self):
+        """(host, expiry) of each permission"""
+        return self._expiries.items()
+
+    def __contains__(self, host):
+        return host in self._expiries
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def __iter__(self):
+        return iter(self._expiries)
+
+    def __repr__(self):
+        return "PermissionTable({})".format(list(self._expiries))
+
+
+class RelayPortPool(object):
+    """UDP sockets bound ahead of time for relayed transport addresses, so
+    allocating a relay does not create or bind a socket
+    :param interface: local address to bind the sockets to
+    :param port_range: (first, last) port numbers to relay from, or None to
+        use ephemeral ports
+    :param size: number of bound sockets to keep ready
+    """
+
+    def __init__(self, interface, port_range=None, size=16):
+        self.interface = interface
+        self.family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+        self.port_range = port_range
+        self.size = size
+        self._sockets = collections.deque()
+        # Unbound ports of the range, allocated in random order
+        # :see: http://tools.ietf.org/html/rfc5766#section-6.2
+        self._ports = collections.deque()
+        if port_range:
+            first, last = port_range
+            ports = list(range(first, last + 1))
+            random.shuffle(ports)
+            self._ports.extend(ports)
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def fill(self):
+        """Bind sockets until the pool holds `size` sockets, or the range is
+        exhausted
+        """
+        while len(self._sockets) < self.size:
+            sock = self._bind()
+            if not sock:
+                break
+            self._sockets.append(sock)
+
+    def take(self):
+        """Take a bound socket from the pool, or bind one if the pool is empty
+        :raises turn.InsufficientCapacityError: if no port is available
+        """
+        sock = self._sockets.popleft() if self._sockets else self._bind()
+        if not sock:
+            raise turn.InsufficientCapacityError()
+        return sock
+
+    def bind(self, port):
+        """Take the pooled socket bound to `port`, or bind one, taking the port
+        from the range
+        :returns: the socket, or None if the port is not available
+        """
+        for sock in self._sockets:
+            if sock.getsockname()[1] == port:
+                self._sockets.remove(sock)
+                return sock
+        if not self.reserve(port):
+            return None
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.interface, port))
+        except OSError:
+            sock.close()
+            self.release(port)
+            return None
+        return sock
+
+    def reserve(self, port):
+        """Take `port` from the range, for a socket bound elsewhere
+        :returns: False if the port is not in the range
+        """
+        if self.port_range:
+            try:
+                self._ports.remove(port)
+            except ValueError:
+                return False
+        return True
+
+    def release(self, port):
+        """Return the port of a closed relay socket to the range"""
+        if self.port_range:
+            self._ports.append(port)
+
+    def close(self):
+        while self._sockets:
+            self._sockets.popleft().close()
+
+    def _bind(self):
+        for _ in range(len(self._ports) if self.port_range else 1):
+            port = self._ports.popleft() if self.port_range else 0
+            sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.interface, port))
+            except OSError:
+                # In use by someone else, try again later
+                sock.close()
+                self.release(port)
+                continue
+            return sock
+        return None
+
+
 class Relay(DatagramProtocol):
     relay_addr = (None, None, None)
+    username = None
+    # Token buckets shaping traffic to peers (send) and from peers (receive)
+    send_buckets = ()
+    receive_buckets = ()
+    # Channel bindings last 10 minutes unless refreshed
+    # :see: http://tools.ietf.org/html/rfc5766#section-11
+    channel_lifetime = 600
+
+    # Send buffer for ChannelData to clients, shared by all relays as datagrams
+    # are written synchronously from the reactor thread
+    _channel_buffer = memoryview(bytearray(ChannelMessage._struct.size + 0xFFFF))
 
     def __init__(self, server, client_addr):
         self.server = server
         self.client_addr = client_addr
 
-        self.permissions = []#('ipaddr', 'lifetime'),]
-        self._channels = {} # channel to peer bindings
-        self._addresses = {} # channel to peer bindings
+        self.permissions = PermissionTable(server.timer_wheel)
+        self._channels = {} # peer host to channel bindings
+        self._addresses = {} # channel to peer (host, port) bindings
+        self._channel_expiries = {} # channel to time the binding expires
+        self.expiry = None
+        self._timer = None
+        self._scheduled = None  # deadline of `_timer`
+
+        # Traffic counters, to peers (sent) and from peers (received)
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_dropped = 0
+        self.packets_shaped = 0
+        self._packet_log = PacketLog(logger, server.log_sample_rate)
+        self._summarized = None
 
     @classmethod
-    def allocate(cls, server, client_addr, port=0):
+    def allocate(cls, server, client_addr):
         relay = cls(server, client_addr)
-        port = server.reactor.listenUDP(port, relay, server.interface)
+        server.adopt_udp(server.relay_ports.take(), relay)
         family = Address.aftof(relay.transport.socket.family)
         relay_ip, port = relay.transport.socket.getsockname()[:2]
         relay.relay_addr = (family, port, relay_ip)
         logger.info("%s Allocated", relay)
+        relay._schedule_summary()
         return relay
 
+    def refresh(self, lifetime):
+        """Set the allocation to expire `lifetime` seconds from now"""
+        wheel = self.server.timer_wheel
+        self.expiry = wheel.clock.seconds() + lifetime
+        # A timer due before the new expiry reschedules itself, only an
+        # earlier expiry needs a new timer
+        if self._scheduled is None or self.expiry < self._scheduled:
+            self._timer = timer = object()
+            self._scheduled = self.expiry
+            wheel.schedule(self.expiry, self._expire, timer)
+
+    def _expire(self, timer):
+        if timer is not self._timer:
+            # Superseded by the timer for an earlier expiry
+            return
+        if self.server._relays.get(self.client_addr) is not self:
+            return
+        self._scheduled = self.expiry
+        if self.server.timer_wheel.due(self.expiry, self._expire, timer):
+            logger.info("%s Expired", self)
+            self.server._deallocate(self.client_addr)
+
+    def deallocate(self):
+        """Close the relayed transport address and return its port"""
+        logger.info("%s Deallocated", self)
+        self.permissions.clear()
+        self._channels.clear()
+        self._addresses.clear()
+        self._channel_expiries.clear()
+        self.transport.stopListening()
+        self.server.relay_ports.release(self.relay_addr[1])
+
+    def _schedule_summary(self):
+        wheel = self.server.timer_wheel
+        wheel.schedule(
+            wheel.clock.seconds() + self.server.relay_summary_interval,
+            self._log_summary,
+        )
+
+    def _log_summary(self):
+        """Log the traffic counters, at most once per summary interval and
+        only if there has been traffic since the previous summary
+        """
+        if self.server._relays.get(self.client_addr) is not self:
+            return
+        counters = (
+            self.packets_sent,
+            self.bytes_sent,
+            self.packets_received,
+            self.bytes_received,
+            self.packets_dropped,
+            self.packets_shaped,
+        )
+        if counters != self._summarized:
+            self._summarized = counters
+            logger.info(
+                "%s Sent %d packets (%d bytes), received %d packets (%d bytes), "
+                "dropped %d packets, shaped %d packets",
+                self,
+                *counters
+            )
+        self._schedule_summary()
+
     def add_permission(self, peer_addr):
         logger.info("%s Added permission for %s", self, peer_addr)
-        self.permissions.append(peer_addr)
+        self.permissions.add(peer_addr)
 
     def bind_channel(self, channel_number, peer_addr):
         logger.info("%s Added channel binding for %s on channel 0x%04x", self, peer_addr, channel_number)
-        if peer_addr.address not in self.permissions:
-            self.add_permission(peer_addr.address)
-        if peer_addr.address not in self._channels:
-            self._channels[peer_addr.address] = channel_number
+        self.add_permission(peer_addr.address)
+        self._bind_channel(channel_number, peer_addr.address, peer_addr.port)
+
+    def _bind_channel(self, channel_number, host, port, lifetime=None):
+        if host not in self._channels:
+            self._channels[host] = channel_number
         if channel_number not in self._addresses:
-            self._addresses[channel_number] = peer_addr
+            self._addresses[channel_number] = (host, port)
+        wheel = self.server.timer_wheel
+        expiry = wheel.clock.seconds() + (lifetime or self.channel_lifetime)
+        if channel_number not in self._channel_expiries:
+            wheel.schedule(expiry, self._expire_channel, channel_number)
+        self._channel_expiries[channel_number] = expiry
+
+    def channels(self):
+        """(channel number, (host, port), expiry) of each channel binding"""
+        return [
+            (channel_number, self._addresses[channel_number], expiry)
+            for channel_number, expiry in self._channel_expiries.items()
+        ]
+
+    def _expire_channel(self, channel_number):
+        expiry = self._channel_expiries.get(channel_number)
+        if expiry is not None and self.server.timer_wheel.due(
+            expiry, self._expire_channel, channel_number
+        ):
+            del self._channel_expiries[channel_number]
+            host, _port = self._addresses.pop(channel_number)
+            if self._channels.get(host) == channel_number:
+                del self._channels[host]
+            logger.info("%s Channel 0x%04x expired", self, channel_number)
 
     def send_channel(self, channel_number, data):
-        peer_addr = self._addresses[channel_number]
-        self.send(data, (peer_addr.address, peer_addr.port))
+        """Send ChannelData payload to the peer bound to `channel_number`"""
+        peer_addr = self._addresses.get(channel_number)
+        if peer_addr and peer_addr[0] in self.permissions:
+            if self.send_buckets and not self._conform(self.send_buckets, len(data)):
+                return
+            self.packets_sent += 1
+            self.bytes_sent += len(data)
+            self.transport.write(data, peer_addr)
+        else:
+            self.packets_dropped += 1
 
     def send(self, data, addr):
-        logger.info("%s -> %s:%d", self, *addr)
         host, _port = addr
         if host in self.permissions:
+            if self.send_buckets and not self._conform(self.send_buckets, len(data)):
+                return
+            if self._packet_log.sampled(self.packets_sent):
+                logger.info("%s -> %s:%d (%d sent)", self, *addr, self.packets_sent + 1)
+            self.packets_sent += 1
+            self.bytes_sent += len(data)
             self.transport.write(data, addr)
         else:
-            logger.warning("No permissions for %s: Dropping Send request", host)
+            self._drop("Send request", data, host)
+
+    def _conform(self, buckets, size):
+        """Take `size` tokens from every bucket, or count the packet as shaped
+        if any of them is short
+        """
+        for i, bucket in enumerate(buckets):
+            if not bucket.consume(size):
+                for taken in buckets[:i]:
+                    taken.refund(size)
+                self.packets_shaped += 1
+                return False
+        return True
+
+    def _drop(self, what, data, host):
+        if self.packets_dropped % self._packet_log.sample_rate == 0:
+            logger.warning(
+                "%s No permissions for %s: Dropping %s (%d dropped)",
+                self,
+                host,
+                what,
+                self.packets_dropped + 1,
+            )
+        self.packets_dropped += 1
+        if self._packet_log.debug_enabled:
             logger.debug(data.hex())
 
     def datagramReceived(self, datagram, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-10.3
         """
-        logger.info("%s <- %s:%d", self, *addr)
         host, port = addr
         if host in self.permissions:
+            if self.receive_buckets and not self._conform(
+                self.receive_buckets, len(datagram)
+            ):
+                return
+            if self._packet_log.sampled(self.packets_received):
+                logger.info(
+                    "%s <- %s:%d (%d received)", self, *addr, self.packets_received + 1
+                )
+            self.packets_received += 1
+            self.bytes_received += len(datagram)
             channel = self._channels.get(host)
             if channel:
-                msg = ChannelMessage.encode(channel, datagram)
+                buffer = self._channel_buffer
+                msg = buffer[: ChannelMessage.encode_into(buffer, channel, datagram)]
             else:
                 msg = Message.from_str(turn.METHOD_DATA, stun.CLASS_INDICATION)
                 family = Address.aftof(self.transport.addressFamily)
@@ -112,8 +434,7 @@ class Relay(DatagramProtocol):
                 msg.add_attr(attributes.Data, datagram)
             self.server.transport.write(msg, self.client_addr)
         else:
-            logger.warning("No permissions for %s: Dropping datagram", host)
-            logger.debug(datagram.hex())
+            self._drop("datagram", datagram, host)
 
     def __str__(self):
         return "Relay(relay-addr={0[2]}:{0[1]}, client-addr={1[0]}:{1[1]})".format(
@@ -1,21 +1,65 @@
+import logging
 from jostedal.stun.server import StunUdpServer
 from jostedal import turn, stun
 from jostedal.stun.attributes import ErrorCode, XorMappedAddress
 from jostedal.turn.attributes import XorRelayedAddress, ReservationToken, Lifetime
 from jostedal.stun.agent import Address
-from jostedal.turn.relay import Relay, ChannelMessage
+from jostedal.stun.credentials import CredentialsPending
+from jostedal.turn.relay import Relay, RelayPortPool, ChannelMessage
+from jostedal.utils import TimerWheel, TokenBucket, address_cache
+
+
+logger = logging.getLogger(__name__)
+
+RELAY_COUNTERS = (
+    "packets_sent",
+    "bytes_sent",
+    "packets_received",
+    "bytes_received",
+    "packets_dropped",
+    "packets_shaped",
+)
 
 
 class TurnUdpServer(StunUdpServer):
     max_lifetime = 3600
     default_lifetime = 600
+    # Log relayed packets sampled 1 in N, and a traffic summary per relay
+    log_sample_rate = 1000
+    relay_summary_interval = 60
+    # Ports (first, last) to relay from, None for ephemeral ports, and the
+    # number of relay sockets to keep bound ahead of allocations
+    relay_port_range = None
+    relay_pool_size = 16
+    # Admission control, None for no limit: allocations per username, in
+    # total, and total bandwidth in bytes per second in each direction, of
+    # which each allocation reserves its allocation_rate, or
+    # allocation_bandwidth if not shaped
+    user_quota = None
+    max_allocations = None
+    max_bandwidth = None
+    allocation_bandwidth = 64000
+    # Traffic shaping in bytes per second, in each direction, per allocation
+    # and per username, None for no limit. Bursts default to one second.
+    allocation_rate = None
+    allocation_burst = None
+    user_rate = None
+    user_burst = None
 
     def __init__(
         self, reactor, interface, port, software, credential_mechanism, overrides={}
     ):
         StunUdpServer.__init__(self, reactor, interface, port, software, overrides)
         self._relays = {}
+        self._user_allocations = {}
+        self._user_buckets = {}
+        # (client address, transaction id) of requests waiting for credentials
+        self._pending = set()
+        # Counters of the relays deallocated so far
+        self._relay_totals = dict.fromkeys(RELAY_COUNTERS, 0)
         self.credential_mechanism = credential_mechanism
+        self.timer_wheel = TimerWheel(reactor)
+        self.relay_ports = None
 
         self._handlers.update(
             {
@@ -38,18 +82,79 @@ class TurnUdpServer(StunUdpServer):
             }
         )
 
+    def start(self, sock=None):
+        self.relay_ports = RelayPortPool(
+            self.interface, self.relay_port_range, self.relay_pool_size
+        )
+        self.relay_ports.fill()
+        self.timer_wheel.start()
+        return StunUdpServer.start(self, sock)
+
+    def reconfigure(
+        self, credential_mechanism=None, software=None, overrides=None, **settings
+    ):
+        """Replace the credential mechanism and settings of the running
+        server. Existing allocations are kept; limits and shaping settings
+        apply to allocations made from now on.
+        :param settings: settings to replace, e.g. `max_allocations`
+        :raises AttributeError: for an unknown setting, before any is changed
+        """
+        for name in settings:
+            if name.startswith("_") or not hasattr(TurnUdpServer, name):
+                raise AttributeError("Unknown setting {!r}".format(name))
+        if credential_mechanism is not None:
+            self.credential_mechanism = credential_mechanism
+        if software is not None and software != self.software:
+            self.software = software
+            self._binding_templates.clear()
+        if overrides is not None:
+            self.overrides = overrides
+        for name, value in settings.items():
+            setattr(self, name, value)
+        if self.relay_ports:
+            self.relay_ports.size = self.relay_pool_size
+
+    def _dispatch(self, handler, msg, addr):
+        try:
+            StunUdpServer._dispatch(self, handler, msg, addr)
+        except CredentialsPending as pending:
+            # Handle the request again once the credentials have been cached,
+            # once for all retransmissions received while waiting
+            key = (addr, msg.transaction_id)
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            pending.deferred.addCallback(self._redispatch, handler, msg, addr)
+            pending.deferred.addErrback(self._redispatch_failed, msg, addr)
+
+    def _redispatch(self, _key, handler, msg, addr):
+        self._pending.discard((addr, msg.transaction_id))
+        self._dispatch(handler, msg, addr)
+
+    def _redispatch_failed(self, failure, msg, addr):
+        self._pending.discard((addr, msg.transaction_id))
+        logger.error(
+            "Failed to handle request from %s:%d: %s", *addr, failure.getTraceback()
+        )
+
     def _stun_allocate_request(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-6.2
         """
-        # Detect retransmission, resend success response
+        # 1. require request to be authenticated, also for retransmissions so
+        # the response has MESSAGE-INTEGRITY
+        self.credential_mechanism.authenticate(msg, addr)
+
+        # Detect retransmission, resend success response. Retransmissions are
+        # normally answered from the response cache, this is for responses
+        # that have been evicted from it.
         relay_allocation = self._relays.get(addr)
         if relay_allocation and relay_allocation.transaction_id == msg.transaction_id:
-            # TODO: handle allocate retransmission
-            raise NotImplementedError("Allocation retransmission")
-
-        # 1. require request to be authenticated
-        self.credential_mechanism.authenticate(msg)
+            time_to_expiry = int(relay_allocation.expiry - self.reactor.seconds())
+            self._allocate_success(
+                msg, addr, relay_allocation.relay_addr, None, max(time_to_expiry, 0)
+            )
+            return
 
         # 2. Check if the 5-tuple is currently in use
         if relay_allocation:
@@ -64,9 +169,16 @@ class TurnUdpServer(StunUdpServer):
 
         # 4. handle DONT-FRAGMENT attribute
 
+        # 7. reject with 486 if username allocation quota reached, and with
+        # 508 if the server is at capacity, before binding any socket
+        username = msg.get_attr(stun.ATTR_USERNAME)
+        username = bytes(username) if username else None
+        self._admit(username)
+
         # 5. Check RESERVATION-TOKEN attribute
-        reservation_token = msg.get_attr(turn.ATTR_RESERVATION_TOKEN)
-        even_port = msg.get_attr(turn.ATTR_EVEN_PORT)
+        reservation_token, even_port = msg.get_attrs(
+            turn.ATTR_RESERVATION_TOKEN, turn.ATTR_EVEN_PORT
+        )
         if reservation_token:
             if even_port:
                 pass  # TODO: reject with 400
@@ -74,17 +186,20 @@ class TurnUdpServer(StunUdpServer):
             # TODO: check that token is in range and has not expired
             # and that corresponding relayed address is still available
             # if token not valid, reject with 508
-        # 7. reject with 486 if username allocation quota reached
         # 8. reject with 300 if we want to redirect to another server RFC5389
         # 6. Check EVEN-PORT
         else:
             relay, token = self._allocate_relay_addr(even_port, addr)
             relay.transaction_id = msg.transaction_id
+            self._add_relay(relay, username)
             relay_addr = relay.relay_addr
 
         # Determine initial time-to-expiry
         time_to_expiry = self._time_to_expiry(msg.get_attr(turn.ATTR_LIFETIME))
+        relay.refresh(time_to_expiry)
+        self._allocate_success(msg, addr, relay_addr, token, time_to_expiry)
 
+    def _allocate_success(self, msg, addr, relay_addr, token, time_to_expiry):
         response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
         response.add_attr(XorRelayedAddress, *relay_addr)
         if token:
@@ -96,6 +211,72 @@ class TurnUdpServer(StunUdpServer):
 
         self.respond(response, addr)
 
+    def _admit(self, username):
+        """
+        :raises turn.AllocationQuotaReachedError: if `username` has
+            `user_quota` allocations
+        :raises turn.InsufficientCapacityError: if the server has
+            `max_allocations` allocations, or not the bandwidth left to
+            reserve for another
+        """
+        if (
+            self.user_quota is not None
+            and self._user_allocations.get(username, 0) >= self.user_quota
+        ):
+            raise turn.AllocationQuotaReachedError()
+        allocations = len(self._relays) + 1
+        if self.max_allocations is not None and allocations > self.max_allocations:
+            raise turn.InsufficientCapacityError()
+        reservation = self.allocation_rate or self.allocation_bandwidth
+        if (
+            self.max_bandwidth is not None
+            and allocations * reservation > self.max_bandwidth
+        ):
+            raise turn.InsufficientCapacityError()
+
+    def _add_relay(self, relay, username):
+        """Add an allocated `relay` of `username` to the relay table"""
+        relay.username = username
+        self._relays[relay.client_addr] = relay
+        self._user_allocations[username] = self._user_allocations.get(username, 0) + 1
+        self._shape(relay)
+
+    def _shape(self, relay):
+        """Give `relay` token buckets for the configured rates, sharing the
+        per-user buckets with the other allocations of its username
+        """
+        send_buckets = []
+        receive_buckets = []
+        if self.allocation_rate:
+            for buckets in (send_buckets, receive_buckets):
+                buckets.append(
+                    TokenBucket(self.reactor, self.allocation_rate, self.allocation_burst)
+                )
+        if self.user_rate:
+            user_buckets = self._user_buckets.get(relay.username)
+            if not user_buckets:
+                user_buckets = self._user_buckets[relay.username] = (
+                    TokenBucket(self.reactor, self.user_rate, self.user_burst),
+                    TokenBucket(self.reactor, self.user_rate, self.user_burst),
+                )
+            send_buckets.append(user_buckets[0])
+            receive_buckets.append(user_buckets[1])
+        relay.send_buckets = tuple(send_buckets)
+        relay.receive_buckets = tuple(receive_buckets)
+
+    def _deallocate(self, addr):
+        """Remove the allocation of client `addr` and close its relay"""
+        relay = self._relays.pop(addr)
+        count = self._user_allocations.get(relay.username, 0) - 1
+        if count > 0:
+            self._user_allocations[relay.username] = count
+        else:
+            self._user_allocations.pop(relay.username, None)
+            self._user_buckets.pop(relay.username, None)
+        relay.deallocate()
+        for counter in RELAY_COUNTERS:
+            self._relay_totals[counter] += getattr(relay, counter)
+
     def _allocate_relay_addr(self, even_port, addr):
         """
         :param even_port: If True, the allocated addres port number will be even
@@ -108,7 +289,8 @@ class TurnUdpServer(StunUdpServer):
         if even_port:
             raise NotImplementedError("EVEN-PORT handling")
         relay = Relay.allocate(self, addr)
-        self._relays[addr] = relay
+        # Replace the pooled socket after responding
+        self.reactor.callLater(0, self.relay_ports.fill)
         return relay, None
 
     def _time_to_expiry(self, lifetime):
@@ -124,6 +306,11 @@ class TurnUdpServer(StunUdpServer):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-7.2
         """
+        self.credential_mechanism.authenticate(msg, addr)
+        relay = self._relays.get(addr)
+        if not relay:
+            raise turn.AllocationMismatchError()
+
         lifetime = msg.get_attr(turn.ATTR_LIFETIME)
         if lifetime and lifetime.time_to_expiry == 0:
             desired_lifetime = 0
@@ -131,22 +318,23 @@ class TurnUdpServer(StunUdpServer):
             desired_lifetime = self._time_to_expiry(lifetime)
 
         if desired_lifetime:
-            response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
-            response.add_attr(Lifetime, desired_lifetime)
-            self.respond(response, addr)
-        elif addr in self._relays:
-            del self._relays[addr]
+            relay.refresh(desired_lifetime)
+        else:
+            self._deallocate(addr)
+        response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
+        response.add_attr(Lifetime, desired_lifetime)
+        self.respond(response, addr)
 
     def _stun_create_permission_request(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-9.2
         """
         # 1. require request to be authenticated
-        message_integrity = msg.get_attr(stun.ATTR_MESSAGE_INTEGRITY)
-        if not message_integrity:
-            raise stun.UnauthorizedError()
+        self.credential_mechanism.authenticate(msg, addr)
 
-        relay = self._relays[addr]
+        relay = self._relays.get(addr)
+        if not relay:
+            raise turn.AllocationMismatchError()
         peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
         relay.add_permission(peer_addr.address)
         response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
@@ -157,9 +345,11 @@ class TurnUdpServer(StunUdpServer):
         :see: http://tools.ietf.org/html/rfc5766#section-10.2
         """
         # TODO: [preliminary implementation]
-        relay = self._relays[addr]
-        peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
-        data = msg.get_attr(turn.ATTR_DATA)
+        relay = self._relays.get(addr)
+        if not relay:
+            # Indications are not answered, discard
+            return
+        peer_addr, data = msg.get_attrs(turn.ATTR_XOR_PEER_ADDRESS, turn.ATTR_DATA)
         relay.send(data, (peer_addr.address, peer_addr.port))
 
     def _stun_channel_bind_request(self, msg, addr):
@@ -167,30 +357,57 @@ class TurnUdpServer(StunUdpServer):
         :see: http://tools.ietf.org/html/rfc5766#section-11.2
         """
         # 1. require request to be authenticated
-        message_integrity = msg.get_attr(stun.ATTR_MESSAGE_INTEGRITY)
-        if not message_integrity:
-            raise stun.UnauthorizedError()
+        self.credential_mechanism.authenticate(msg, addr)
 
         # 2. require CHANNEL-NUMBER and XOR-PEER-ADDRESS attributes
         # 3. require channel number is in valid range (0x4000 - 0x4FFF inclusive)
         # 4. require channel number is not currently bound to a different transport address (same transport address is OK)
         # 5. require transport address is not currently bound to a different channel number
 
-        relay = self._relays[addr]
-        peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
-        channel_number = msg.get_attr(turn.ATTR_CHANNEL_NUMBER)
+        relay = self._relays.get(addr)
+        if not relay:
+            raise turn.AllocationMismatchError()
+        peer_addr, channel_number = msg.get_attrs(
+            turn.ATTR_XOR_PEER_ADDRESS, turn.ATTR_CHANNEL_NUMBER
+        )
         relay.bind_channel(channel_number.channel_number, peer_addr)
         response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
         self.respond(response, addr)
 
-    def _stun_unhandled_datagram(self, datagram, addr):
-        msg_type = datagram[0] >> 6
-        if msg_type == turn.MSG_CHANNEL:
-            msg = ChannelMessage.decode(datagram)
-            relay = self._relays[addr]
-            relay.send_channel(msg.channel_number, memoryview(msg)[4:])
+    def datagramReceived(self, datagram, addr):
+        if datagram[0] >> 6 == turn.MSG_CHANNEL:
+            self._channel_data_received(datagram, addr)
         else:
-            super()._stun_unhandled_datagram(datagram, addr)
+            StunUdpServer.datagramReceived(self, datagram, addr)
+
+    def _channel_data_received(self, datagram, addr):
+        """Relay ChannelData to the peer bound to the channel, without
+        decoding it into a ChannelMessage. Invalid or unbound ChannelData is
+        silently discarded.
+        :see: http://tools.ietf.org/html/rfc5766#section-11.6
+        """
+        relay = self._relays.get(addr)
+        if relay and len(datagram) >= ChannelMessage._struct.size:
+            channel_number, length = ChannelMessage._struct.unpack_from(datagram)
+            end = ChannelMessage._struct.size + length
+            if end <= len(datagram):
+                payload = memoryview(datagram)[ChannelMessage._struct.size : end]
+                relay.send_channel(channel_number, payload)
+
+    def stats(self):
+        """Allocation and traffic counters, summed over all relays since the
+        server started
+        """
+        stats = dict(self._relay_totals)
+        for relay in self._relays.values():
+            for counter in RELAY_COUNTERS:
+                stats[counter] += getattr(relay, counter)
+        stats["allocations"] = len(self._relays)
+        stats["messages_received"] = self.messages_received
+        # Flat, for the supervisor to sum over workers
+        for key, value in address_cache.stats().items():
+            stats["address_cache_" + key] = value
+        return stats
 
     def __str__(self):
         return (
@@ -0,0 +1,341 @@
+"""Snapshots of the allocations of a `TurnUdpServer`, to restore them in a new
+server process
+
+A snapshot holds, for each relay, its client and relayed transport addresses,
+username, the transaction id of its Allocate request, and the remaining
+lifetimes of the allocation, its permissions and its channel bindings. It is
+written to a file with `Snapshotter`, or handed over with the sockets of the
+server and its relays to a new process with `HandoffListener` and
+`receive_handoff`, so the relayed transport addresses survive a restart:
+
+    # Old process
+    reactor.addReader(HandoffListener(server, path, reactor.stop))
+    # New process
+    data, sock, relay_sockets = receive_handoff(path)
+    server.start(sock)
+    restore(server, data, relay_sockets)
+"""
+
+import logging
+import os
+import socket
+import struct
+import time
+from jostedal.stun.agent import Address
+from jostedal.turn.relay import Relay
+from jostedal.utils import address_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b"JSNP"
+VERSION = 1
+
+_header_struct = struct.Struct(">4sBdL")  # magic, version, time, relays
+_address_struct = struct.Struct(">BH")  # family, port, followed by the address
+_relay_struct = struct.Struct(">12sfHH")  # transaction id, lifetime, counts
+_permission_struct = struct.Struct(">Bf")  # family, lifetime, address
+_channel_struct = struct.Struct(">HfBH")  # channel, lifetime, family, port, address
+_length_struct = struct.Struct(">H")
+
+_address_lengths = {Address.FAMILY_IPv4: 4, Address.FAMILY_IPv6: 16}
+
+
+def _family(host):
+    return Address.FAMILY_IPv6 if ":" in host else Address.FAMILY_IPv4
+
+
+def _address_length(family):
+    try:
+        return _address_lengths[family]
+    except KeyError:
+        raise ValueError("Unknown address family {:#04x}".format(family))
+
+
+def _pack_address(family, host, port):
+    af = Address.ftoaf(family)
+    return _address_struct.pack(family, port) + address_cache.pton(af, host)
+
+
+def _unpack_address(data, offset):
+    family, port = _address_struct.unpack_from(data, offset)
+    offset += _address_struct.size
+    end = offset + _address_length(family)
+    host = address_cache.ntop(Address.ftoaf(family), bytes(data[offset:end]))
+    return family, host, port, end
+
+
+def dumps(server):
+    """Snapshot of the allocations of `server`"""
+    now = server.reactor.seconds()
+    chunks = [_header_struct.pack(MAGIC, VERSION, time.time(), len(server._relays))]
+    for relay in server._relays.values():
+        permissions = list(relay.permissions.expiries())
+        channels = relay.channels()
+        host, port = relay.client_addr
+        chunks.append(_pack_address(_family(host), host, port))
+        family, relay_port, relay_host = relay.relay_addr
+        chunks.append(_pack_address(family, relay_host, relay_port))
+        username = relay.username or b""
+        chunks.append(_length_struct.pack(len(username)) + username)
+        chunks.append(
+            _relay_struct.pack(
+                relay.transaction_id,
+                relay.expiry - now,
+                len(permissions),
+                len(channels),
+            )
+        )
+        for host, expiry in permissions:
+            family = _family(host)
+            chunks.append(_permission_struct.pack(family, expiry - now))
+            chunks.append(address_cache.pton(Address.ftoaf(family), host))
+        for channel_number, (host, port), expiry in channels:
+            family = _family(host)
+            chunks.append(_channel_struct.pack(channel_number, expiry - now, family, port))
+            chunks.append(address_cache.pton(Address.ftoaf(family), host))
+    return b"".join(chunks)
+
+
+def restore(server, data, sockets=None):
+    """Restore the allocations in snapshot `data` on the started `server`.
+    Relays are bound to the same ports again, or listen on the sockets
+    handed over for them.
+    :param sockets: relay sockets by port, as returned by `receive_handoff`
+    :returns: the number of allocations restored
+    """
+    sockets = dict(sockets or {})
+    magic, version, saved, count = _header_struct.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version {} snapshot".format(VERSION))
+    offset = _header_struct.size
+    elapsed = max(time.time() - saved, 0)
+    restored = 0
+    for _ in range(count):
+        _client_family, client_host, client_port, offset = _unpack_address(
+            data, offset
+        )
+        family, relay_host, relay_port, offset = _unpack_address(data, offset)
+        (length,) = _length_struct.unpack_from(data, offset)
+        offset += _length_struct.size
+        username = bytes(data[offset : offset + length]) or None
+        offset += length
+        transaction_id, lifetime, permission_count, channel_count = (
+            _relay_struct.unpack_from(data, offset)
+        )
+        offset += _relay_struct.size
+        permissions = []
+        for _ in range(permission_count):
+            family_, remaining = _permission_struct.unpack_from(data, offset)
+            offset += _permission_struct.size
+            end = offset + _address_length(family_)
+            host = address_cache.ntop(Address.ftoaf(family_), bytes(data[offset:end]))
+            permissions.append((host, remaining - elapsed))
+            offset = end
+        channels = []
+        for _ in range(channel_count):
+            channel_number, remaining, family_, port = _channel_struct.unpack_from(
+                data, offset
+            )
+            offset += _channel_struct.size
+            end = offset + _address_length(family_)
+            host = address_cache.ntop(Address.ftoaf(family_), bytes(data[offset:end]))
+            channels.append((channel_number, host, port, remaining - elapsed))
+            offset = end
+
+        client_addr = (client_host, client_port)
+        lifetime -= elapsed
+        sock = sockets.pop(relay_port, None)
+        if lifetime <= 0 or client_addr in server._relays:
+            if sock:
+                sock.close()
+            continue
+        if sock is not None:
+            server.relay_ports.reserve(relay_port)
+        else:
+            sock = server.relay_ports.bind(relay_port)
+            if sock is None:
+                logger.warning(
+                    "Relay port %d is not available, dropping the allocation of "
+                    "%s:%d",
+                    relay_port,
+                    *client_addr
+                )
+                continue
+        relay = Relay(server, client_addr)
+        server.adopt_udp(sock, relay)
+        relay.relay_addr = (family, relay_port, relay_host)
+        relay.transaction_id = transaction_id
+        server._add_relay(relay, username)
+        relay.refresh(lifetime)
+        for host, remaining in permissions:
+            if remaining > 0:
+                relay.permissions.add(host, remaining)
+        for channel_number, host, port, remaining in channels:
+            if remaining > 0:
+                relay._bind_channel(channel_number, host, port, remaining)
+        relay._schedule_summary()
+        logger.info("%s Restored", relay)
+        restored += 1
+    for sock in sockets.values():
+        sock.close()
+    return restored
+
+
+def save(server, path):
+    """Write a snapshot of `server` to the file at `path`, atomically"""
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as fp:
+        fp.write(dumps(server))
+    os.replace(temporary, path)
+
+
+def load(server, path):
+    """Restore the allocations in the snapshot file at `path`, if any
+    :returns: the number of allocations restored
+    """
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return 0
+    return restore(server, data)
+
+
+class Snapshotter(object):
+    """Writes snapshots of a server to a file every `interval` seconds"""
+
+    def __init__(self, server, path, interval=60):
+        self.server = server
+        self.path = path
+        self.interval = interval
+        self._call = None
+
+    def start(self):
+        self._call = self.server.reactor.callLater(self.interval, self._save)
+
+    def stop(self):
+        if self._call:
+            self._call.cancel()
+            self._call = None
+
+    def save(self):
+        try:
+            save(self.server, self.path)
+        except OSError:
+            logger.exception("Failed to write snapshot to %s", self.path)
+
+    def _save(self):
+        self.save()
+        self.start()
+
+
+# The kernel passes at most SCM_MAX_FD (253) file descriptors per message
+_MAX_FDS = 253
+_CHUNK_SIZE = 32768
+_handoff_struct = struct.Struct(">LL")  # snapshot length, file descriptors
+
+
+def send_handoff(server, conn):
+    """Send a snapshot of `server` and the sockets of the server and its
+    relays over the connected SOCK_SEQPACKET Unix socket `conn`
+    """
+    data = dumps(server)
+    fds = [server.transport.socket.fileno()]
+    fds.extend(relay.transport.socket.fileno() for relay in server._relays.values())
+    socket.send_fds(conn, [_handoff_struct.pack(len(data), len(fds))], fds[:_MAX_FDS])
+    for i in range(_MAX_FDS, len(fds), _MAX_FDS):
+        socket.send_fds(conn, [b"F"], fds[i : i + _MAX_FDS])
+    for i in range(0, len(data), _CHUNK_SIZE):
+        conn.sendall(data[i : i + _CHUNK_SIZE])
+
+
+def receive_handoff(path, timeout=5):
+    """Request the allocations and sockets of the server process listening
+    for handoffs at `path`
+    :returns: (snapshot, server socket, relay sockets by port), or
+        (None, None, None) if no process is listening
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None, None, None
+    with conn:
+        header, fds, _flags, _addr = socket.recv_fds(
+            conn, _handoff_struct.size, _MAX_FDS
+        )
+        length, count = _handoff_struct.unpack(header)
+        while len(fds) < count:
+            _data, more_fds, _flags, _addr = socket.recv_fds(conn, 1, _MAX_FDS)
+            fds.extend(more_fds)
+        chunks = []
+        received = 0
+        while received < length:
+            chunk = conn.recv(_CHUNK_SIZE)
+            if not chunk:
+                raise EOFError("Handoff interrupted")
+            chunks.append(chunk)
+            received += len(chunk)
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    relay_sockets = {sock.getsockname()[1]: sock for sock in sockets[1:]}
+    return b"".join(chunks), sockets[0], relay_sockets
+
+
+class HandoffListener(object):
+    """Hands the allocations and sockets of a server over to a new process
+    calling `receive_handoff`, then calls `on_handoff`, which should stop
+    this process. Added to a Twisted reactor with `reactor.addReader`.
+    """
+
+    def __init__(self, server, path, on_handoff):
+        self.server = server
+        self.path = path
+        self.on_handoff = on_handoff
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.socket.bind(path)
+        self.socket.listen()
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def doRead(self):
+        try:
+            conn, _addr = self.socket.accept()
+        except BlockingIOError:
+            return
+        # Remove the path before the new process listens on it
+        self.server.reactor.removeReader(self)
+        self.close()
+        with conn:
+            conn.setblocking(True)
+            try:
+                send_handoff(self.server, conn)
+            except OSError:
+                logger.exception("Handoff failed, keeping the allocations")
+                return
+        logger.info("Handed over %d allocations", len(self.server._relays))
+        # Stop reading, the new process reads from the sockets from now on
+        self.server.transport.stopListening()
+        for relay in self.server._relays.values():
+            relay.transport.stopListening()
+        self.server._relays.clear()
+        self.on_handoff()
+
+    def close(self):
+        if self.socket.fileno() != -1:
+            self.socket.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def connectionLost(self, reason):
+        self.close()
+
+    def logPrefix(self):
+        return "HandoffListener"
@@ -1,4 +1,11 @@
 import hashlib
+import functools
+import logging
+import math
+import socket
+
+
+logger = logging.getLogger(__name__)
 
 
 def saslprep(string):
@@ -10,3 +17,206 @@ def ha1(username, realm, password):
     return hashlib.md5(
         ":".join((username, realm, saslprep(password))).encode()
     ).digest()
+
+
+def reuse_port_socket(interface, port):
+    """UDP socket bound to `port` with SO_REUSEPORT, to share the port with
+    other sockets bound the same way
+    """
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class AddressCache(object):
+    """Bounded LRU caches for converting IP addresses between packed and
+    textual form. Repeated lookups return the same string/bytes object.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.resize(maxsize)
+
+    def resize(self, maxsize):
+        """Replace the caches with empty caches holding `maxsize` entries each"""
+        self.maxsize = maxsize
+        self.ntop = functools.lru_cache(maxsize)(socket.inet_ntop)
+        self.pton = functools.lru_cache(maxsize)(socket.inet_pton)
+
+    def stats(self):
+        ntop = self.ntop.cache_info()
+        pton = self.pton.cache_info()
+        return {
+            "maxsize": self.maxsize,
+            "ntop_hits": ntop.hits,
+            "ntop_misses": ntop.misses,
+            "ntop_size": ntop.currsize,
+            "pton_hits": pton.hits,
+            "pton_misses": pton.misses,
+            "pton_size": pton.currsize,
+        }
+
+
+# Shared by the STUN address attributes and the TURN relays
+address_cache = AddressCache()
+
+
+class PacketLog(object):
+    """Logging policy for log messages emitted per packet
+
+    The enabled levels of `logger` are looked up once, when created or
+    updated, instead of for every packet, and only 1 in `sample_rate`
+    packets is logged.
+    """
+
+    def __init__(self, logger, sample_rate=1):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.update()
+
+    def update(self):
+        """Look up the enabled levels again, e.g. after logging is configured"""
+        self.info_enabled = self.logger.isEnabledFor(logging.INFO)
+        self.debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+    def sampled(self, count):
+        """Whether the packet numbered `count` should be logged at INFO level"""
+        return self.info_enabled and count % self.sample_rate == 0
+
+
+class TimerWheel(object):
+    """Coarse grained timers for large numbers of expiring entries
+
+    All timers share a single reactor call per tick, rather than one
+    `callLater` handle each. Timers can not be cancelled, callbacks are
+    expected to check whether their entry is still due when invoked.
+
+    The wheel is hierarchical: each level has `size` slots, and a slot of a
+    level spans a full turn of the level below it. Timers are kept in the
+    finest level that can hold them, and moved down a level whenever the
+    level below completes a turn, so timers far in the future are not
+    revisited every turn of the finest level.
+
+    :param clock: provider of `seconds` and `callLater`, e.g. the reactor
+    :param tick: resolution of the wheel in seconds
+    :param size: number of slots per level
+    :param levels: number of levels; deadlines beyond `tick * size ** levels`
+        seconds are carried around the last level until they are due
+    """
+
+    def __init__(self, clock, tick=1.0, size=512, levels=2):
+        self.clock = clock
+        self.tick = tick
+        self._size = size
+        self._levels = [[[] for _ in range(size)] for _ in range(levels)]
+        self._ticks = 0
+        self._time = clock.seconds()
+        self._call = None
+
+    def __len__(self):
+        return sum(len(slot) for slots in self._levels for slot in slots)
+
+    def schedule(self, when, callback, *args):
+        """Call `callback(*args)` at the first tick at or after `when`"""
+        self._insert(when, (when, callback, args), 1)
+
+    def due(self, expiry, callback, *args):
+        """For timer callbacks of entries that can be refreshed: whether
+        `expiry` has passed, or else schedule `callback(*args)` again for the
+        refreshed `expiry`
+        """
+        if expiry <= self.clock.seconds():
+            return True
+        self.schedule(expiry, callback, *args)
+        return False
+
+    def _insert(self, when, entry, min_ticks):
+        ticks = self._ticks + max(math.ceil((when - self._time) / self.tick), min_ticks)
+        size = self._size
+        scale = 1
+        for slots in self._levels:
+            if ticks // scale - self._ticks // scale < size:
+                break
+            scale *= size
+        else:
+            # Beyond the last level, park in its farthest slot
+            scale //= size
+            ticks = (self._ticks // scale + size - 1) * scale
+        slots[ticks // scale % size].append(entry)
+
+    def start(self):
+        if not self._call:
+            self._time = self.clock.seconds()
+            self._call = self.clock.callLater(self.tick, self._advance)
+
+    def stop(self):
+        if self._call:
+            self._call.cancel()
+            self._call = None
+
+    def _advance(self):
+        now = self.clock.seconds()
+        size = self._size
+        while self._time + self.tick <= now:
+            self._time += self.tick
+            self._ticks += 1
+            # Move timers down from every level that starts a new slot, the
+            # coarsest first
+            scale = size ** (len(self._levels) - 1)
+            for slots in reversed(self._levels[1:]):
+                if self._ticks % scale == 0:
+                    index = self._ticks // scale % size
+                    slot, slots[index] = slots[index], []
+                    for entry in slot:
+                        self._insert(entry[0], entry, 0)
+                scale //= size
+            slots = self._levels[0]
+            index = self._ticks % size
+            slot, slots[index] = slots[index], []
+            for entry in slot:
+                when, callback, args = entry
+                if when > self._time:
+                    self._insert(when, entry, 1)
+                else:
+                    try:
+                        callback(*args)
+                    except Exception:
+                        logger.exception("Timer callback %r failed", callback)
+        self._call = self.clock.callLater(self._time + self.tick - now, self._advance)
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, refilled lazily from the time elapsed since
+    it was last used rather than by a timer
+    :param clock: provider of `seconds`, e.g. the reactor
+    :param rate: tokens added per second
+    :param burst: capacity of the bucket, defaults to one second of tokens
+    """
+
+    def __init__(self, clock, rate, burst=None):
+        self.clock = clock
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self._time = clock.seconds()
+
+    def consume(self, amount):
+        """Take `amount` tokens if the bucket holds that many
+        :returns: whether the tokens were taken
+        """
+        now = self.clock.seconds()
+        tokens = min(self.burst, self.tokens + (now - self._time) * self.rate)
+        self._time = now
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+    def refund(self, amount):
+        self.tokens = min(self.burst, self.tokens + amount)
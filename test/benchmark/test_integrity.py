@@ -0,0 +1,39 @@
+import unittest
+import timeit
+from jostedal import stun, turn
+from jostedal.stun.agent import Message
+from jostedal.stun.attributes import MessageIntegrity
+from jostedal.turn import attributes
+from jostedal.utils import ha1
+
+
+class IntegrityBenchmark(unittest.TestCase):
+    """Allocate requests per second with a raw and a prepared HMAC key"""
+
+    number = 20000
+
+    def build_allocate_request(self, key):
+        msg = Message.from_str(turn.METHOD_ALLOCATE, stun.CLASS_REQUEST)
+        msg.add_attr(attributes.RequestedTransport, turn.TRANSPORT_UDP)
+        msg.add_attr(MessageIntegrity, key)
+        return msg
+
+    def measure(self, key):
+        seconds = timeit.timeit(
+            lambda: self.build_allocate_request(key), number=self.number
+        )
+        return self.number / seconds
+
+    def test_integrity(self):
+        key = ha1("username", "realm", "password")
+        rates = {
+            "raw": self.measure(key),
+            "prepared": self.measure(MessageIntegrity.prepare_key(key)),
+        }
+        for name, rate in rates.items():
+            print("{:>8} key: {:10.0f} msg/s".format(name, rate))
+            self.assertGreater(rate, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
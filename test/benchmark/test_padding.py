@@ -0,0 +1,48 @@
+import unittest
+import timeit
+from jostedal import stun, turn
+from jostedal.stun.agent import (
+    Message,
+    Address,
+    zero_padding,
+    urandom_padding,
+    RandomPoolPadding,
+)
+from jostedal.turn import attributes
+
+
+class PaddingBenchmark(unittest.TestCase):
+    """Data indications per second with each padding strategy"""
+
+    number = 5000
+
+    def build_data_indication(self):
+        msg = Message.from_str(turn.METHOD_DATA, stun.CLASS_INDICATION)
+        msg.add_attr(
+            attributes.XorPeerAddress, Address.FAMILY_IPv4, 1337, "192.168.2.255"
+        )
+        msg.add_attr(attributes.Data, b"x" * 161)
+        return msg
+
+    def measure(self, padding):
+        previous = Message._padding
+        Message.set_padding(padding)
+        try:
+            seconds = timeit.timeit(self.build_data_indication, number=self.number)
+        finally:
+            Message.set_padding(previous)
+        return self.number / seconds
+
+    def test_padding(self):
+        rates = {
+            "zero": self.measure(zero_padding),
+            "pool": self.measure(RandomPoolPadding()),
+            "urandom": self.measure(urandom_padding),
+        }
+        for name, rate in rates.items():
+            print("{:>8} padding: {:10.0f} msg/s".format(name, rate))
+            self.assertGreater(rate, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import asyncio
+import socket
+from jostedal import stun, turn
+from jostedal.aio import AsyncioReactor, new_event_loop
+from jostedal.stun.agent import Message
+from jostedal.stun.server import StunUdpServer
+from jostedal.stun.authentication import LongTermCredentialMechanism
+from jostedal.turn.relay import Relay
+from jostedal.turn.server import TurnUdpServer
+
+
+class AsyncioReactorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = new_event_loop()
+        self.reactor = AsyncioReactor(self.loop)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.setblocking(False)
+        self.client.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def receive(self, sock):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(self.loop.sock_recvfrom(sock, 4096), 2)
+        )
+
+    def test_binding(self):
+        server = StunUdpServer(self.reactor, "127.0.0.1", 0, "jostedal")
+        port = server.start()
+        request = Message.from_str(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        self.client.sendto(request, ("127.0.0.1", port))
+
+        data, _addr = self.receive(self.client)
+        response = Message.from_buffer(data)
+        self.assertEqual(response.transaction_id, request.transaction_id)
+        address = response.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual(
+            (address.address, address.port), self.client.getsockname()
+        )
+        server.transport.stopListening()
+
+    def test_relay(self):
+        credential_mechanism = LongTermCredentialMechanism("realm")
+        server = TurnUdpServer(
+            self.reactor, "127.0.0.1", 0, "jostedal", credential_mechanism
+        )
+        server.start()
+        relay = Relay.allocate(server, self.client.getsockname())
+        server._relays[relay.client_addr] = relay
+
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.setblocking(False)
+        peer.bind(("127.0.0.1", 0))
+        relay.add_permission("127.0.0.1")
+        relay.send(b"hello", peer.getsockname())
+        data, relay_addr = self.receive(peer)
+        self.assertEqual(data, b"hello")
+        self.assertEqual(relay_addr[1], relay.relay_addr[1])
+
+        peer.sendto(b"world", relay_addr)
+        data, _addr = self.receive(self.client)
+        indication = Message.from_buffer(data)
+        self.assertEqual(indication.msg_method, turn.METHOD_DATA)
+        self.assertEqual(indication.get_attr(turn.ATTR_DATA), b"world")
+        peer.close()
+        relay.transport.stopListening()
+        server.transport.stopListening()
+
+
+if __name__ == "__main__":
+    unittest.main()
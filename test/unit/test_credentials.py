@@ -0,0 +1,139 @@
+import unittest
+import http.server
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+from twisted.internet import defer
+from jostedal.stun.authentication import LongTermCredentialMechanism
+from jostedal.stun.credentials import (
+    CredentialCache,
+    CredentialProvider,
+    CredentialsPending,
+    FileCredentialProvider,
+    HttpCredentialProvider,
+    SqliteCredentialProvider,
+)
+from jostedal.utils import ha1
+
+
+class StubProvider(CredentialProvider):
+    def __init__(self):
+        self.lookups = []
+
+    def lookup(self, username):
+        d = defer.Deferred()
+        self.lookups.append((username, d))
+        return d
+
+
+class CredentialCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.cache = CredentialCache(
+            self.provider, lambda username, credentials: credentials["key"]
+        )
+
+    def test_coalesced(self):
+        waiters = []
+        for _ in range(3):
+            with self.assertRaises(CredentialsPending) as pending:
+                self.cache.get("alice")
+            waiters.append(pending.exception.deferred)
+        self.assertEqual(len(self.provider.lookups), 1)
+        results = []
+        for waiter in waiters:
+            waiter.addCallback(results.append)
+        self.provider.lookups[0][1].callback({"key": b"key"})
+        self.assertEqual(results, [b"key"] * 3)
+        self.assertEqual(self.cache.get("alice"), b"key")
+        self.assertEqual(len(self.provider.lookups), 1)
+
+    def test_negative(self):
+        self.assertRaises(CredentialsPending, self.cache.get, "alice")
+        self.provider.lookups[0][1].callback(None)
+        self.assertIsNone(self.cache.get("alice"))
+        self.assertRaises(CredentialsPending, self.cache.get, "bob")
+        self.provider.lookups[1][1].errback(RuntimeError("unavailable"))
+        self.assertIsNone(self.cache.get("bob"))
+        with mock.patch("time.time", return_value=time.time() + 30):
+            self.assertRaises(CredentialsPending, self.cache.get, "alice")
+
+    def test_ttl(self):
+        self.assertRaises(CredentialsPending, self.cache.get, "alice")
+        self.provider.lookups[0][1].callback({"key": b"key"})
+        with mock.patch("time.time", return_value=time.time() + 299):
+            self.assertEqual(self.cache.get("alice"), b"key")
+        with mock.patch("time.time", return_value=time.time() + 300):
+            self.assertRaises(CredentialsPending, self.cache.get, "alice")
+
+    def test_mechanism(self):
+        mechanism = LongTermCredentialMechanism("realm", provider=self.provider)
+        self.assertRaises(CredentialsPending, mechanism.get_key, "alice")
+        self.provider.lookups[0][1].callback({"password": "pass"})
+        expected = mechanism._derive_key(
+            "alice", {"key": ha1("alice", "realm", "pass").hex()}
+        )
+        self.assertEqual(mechanism.get_key("alice").digest(), expected.digest())
+
+
+class ProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_file(self):
+        path = os.path.join(self.directory.name, "users.json")
+        with open(path, "w") as fp:
+            json.dump({"alice": {"password": "pass"}}, fp)
+        provider = FileCredentialProvider(None, path)
+        self.assertEqual(provider._lookup("alice"), {"password": "pass"})
+        with open(path, "w") as fp:
+            json.dump({"bob": {"key": "00ff"}}, fp)
+        os.utime(path, (0, 0))
+        self.assertIsNone(provider._lookup("alice"))
+        self.assertEqual(provider._lookup("bob"), {"key": "00ff"})
+
+    def test_sqlite(self):
+        path = os.path.join(self.directory.name, "users.db")
+        with sqlite3.connect(path) as connection:
+            connection.execute("CREATE TABLE users (username, password, key)")
+            connection.execute("INSERT INTO users VALUES ('alice', 'pass', NULL)")
+            connection.execute("INSERT INTO users VALUES ('bob', NULL, '00ff')")
+        provider = SqliteCredentialProvider(None, path)
+        self.assertEqual(provider._lookup("alice"), {"password": "pass"})
+        self.assertEqual(provider._lookup("bob"), {"key": "00ff"})
+        self.assertIsNone(provider._lookup("carol"))
+
+    def test_http(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/users/alice%40example.com":
+                    body = json.dumps({"password": "pass"}).encode()
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        provider = HttpCredentialProvider(
+            None, "http://127.0.0.1:%d/users/{username}" % server.server_port
+        )
+        self.assertEqual(provider._lookup("alice@example.com"), {"password": "pass"})
+        self.assertIsNone(provider._lookup("bob"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import socket
+from unittest import mock
+from twisted.internet import error
+from twisted.internet.protocol import DatagramProtocol
+from jostedal import mmsg
+
+
+@unittest.skipUnless(mmsg.available, "recvmmsg/sendmmsg not available")
+class BatchIOTest(unittest.TestCase):
+    def setUp(self):
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.bind(("127.0.0.1", 0))
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_send_and_receive(self):
+        addr = self.receiver.getsockname()
+        datagrams = [(bytes([i]) * (i + 1), addr) for i in range(5)]
+        sent = mmsg.sendmmsg(self.sender.fileno(), socket.AF_INET, datagrams)
+        self.assertEqual(sent, 5)
+
+        batch = mmsg.RecvBatch(4, 2048)
+        received = batch.recv(self.receiver.fileno())
+        received += batch.recv(self.receiver.fileno())
+        self.assertEqual(
+            received,
+            [(datagram, self.sender.getsockname()) for datagram, _ in datagrams],
+        )
+
+    def test_receive_nothing(self):
+        batch = mmsg.RecvBatch(4, 2048)
+        with self.assertRaises(BlockingIOError):
+            batch.recv(self.receiver.fileno())
+
+
+class StubReactor(object):
+    def addReader(self, reader):
+        pass
+
+    def removeReader(self, reader):
+        pass
+
+    def removeWriter(self, writer):
+        pass
+
+    def callLater(self, delay, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class EchoProtocol(DatagramProtocol):
+    """Echoes datagrams, and tries to write to an IPv6 address first"""
+
+    def datagramReceived(self, datagram, addr):
+        try:
+            self.transport.write(datagram, ("2001:db8::1", 5000))
+        except error.InvalidAddressError:
+            pass
+        self.transport.write(datagram, addr)
+
+
+@unittest.skipUnless(mmsg.available, "recvmmsg/sendmmsg not available")
+class BatchUdpPortTest(unittest.TestCase):
+    def setUp(self):
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(1)
+        self.port = mmsg.listen_udp(StubReactor(), 0, EchoProtocol(), "127.0.0.1")
+
+    def tearDown(self):
+        self.client.close()
+        self.port.stopListening()
+
+    def test_invalid_address(self):
+        server_addr = ("127.0.0.1", self.port.getHost().port)
+        for datagram in (b"a", b"b"):
+            self.client.sendto(datagram, server_addr)
+            self.port.doRead()
+            self.assertEqual(self.client.recv(16), datagram)
+        self.assertTrue(self.port.connected)
+        self.assertEqual(mmsg._Batch.pending, [])
+
+    def test_flush_failure(self):
+        other = mmsg.listen_udp(StubReactor(), 0, EchoProtocol(), "127.0.0.1")
+        self.addCleanup(other.stopListening)
+        mmsg._Batch.depth += 1
+        try:
+            self.port.write(b"a", self.client.getsockname())
+            other.write(b"b", self.client.getsockname())
+        finally:
+            mmsg._Batch.depth -= 1
+        with mock.patch.object(self.port, "flush", side_effect=OSError()):
+            with self.assertLogs("jostedal.mmsg", "ERROR"):
+                mmsg._Batch.flush()
+        self.assertEqual(self.client.recv(16), b"b")
+        self.assertEqual(other._queue, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import os
+import socket
+import tempfile
+import threading
+from unittest import mock
+from twisted.internet import task
+from jostedal.stun.agent import Address
+from jostedal.stun.authentication import LongTermCredentialMechanism
+from jostedal.turn import snapshot
+from jostedal.turn.relay import Relay, RelayPortPool
+from jostedal.turn.server import TurnUdpServer
+
+
+class SocketTransport(object):
+    def __init__(self, sock):
+        self.socket = sock
+
+    def stopListening(self):
+        self.socket.close()
+
+
+class SnapshotTest(unittest.TestCase):
+    client_addr = ("10.0.0.1", 5000)
+
+    def setUp(self):
+        self.server = self.create_server()
+        relay = Relay.allocate(self.server, self.client_addr)
+        relay.transaction_id = b"0123456789ab"
+        self.server._add_relay(relay, b"alice")
+        relay.refresh(600)
+        relay.add_permission("10.0.0.2")
+        relay._bind_channel(0x4000, "10.0.0.3", 6000)
+        self.relay = relay
+
+    def create_server(self):
+        server = TurnUdpServer(
+            task.Clock(),
+            "127.0.0.1",
+            0,
+            "jostedal",
+            LongTermCredentialMechanism("realm"),
+        )
+        server.relay_ports = RelayPortPool("127.0.0.1", size=0)
+        server.adopt_udp = lambda sock, protocol: setattr(
+            protocol, "transport", SocketTransport(sock)
+        )
+        self.addCleanup(self.close, server)
+        return server
+
+    def close(self, server):
+        for relay in server._relays.values():
+            relay.transport.stopListening()
+
+    def test_restore(self):
+        port = self.relay.relay_addr[1]
+        sockets = {port: self.relay.transport.socket.dup()}
+        server = self.create_server()
+        server.reactor.advance(100)
+        with mock.patch("time.time", return_value=1000.0):
+            data = snapshot.dumps(self.server)
+            self.assertEqual(snapshot.restore(server, data, sockets), 1)
+        relay = server._relays[self.client_addr]
+        self.assertEqual(relay.relay_addr, (Address.FAMILY_IPv4, port, "127.0.0.1"))
+        self.assertEqual(relay.transaction_id, b"0123456789ab")
+        self.assertEqual(relay.username, b"alice")
+        self.assertEqual(server._user_allocations, {b"alice": 1})
+        self.assertIn("10.0.0.2", relay.permissions)
+        ((channel_number, peer_addr, expiry),) = relay.channels()
+        self.assertEqual((channel_number, peer_addr), (0x4000, ("10.0.0.3", 6000)))
+        self.assertEqual(expiry, 700)
+        self.assertEqual(relay.expiry, 700)
+        # Restoring again does not replace the allocation
+        self.assertEqual(snapshot.restore(server, data), 0)
+
+    def test_rebind(self):
+        data = snapshot.dumps(self.server)
+        port = self.relay.relay_addr[1]
+        server = self.create_server()
+        self.assertEqual(snapshot.restore(server, data), 0)
+        self.relay.transport.stopListening()
+        self.server._relays.clear()
+        self.assertEqual(snapshot.restore(server, data), 1)
+        relay = server._relays[self.client_addr]
+        self.assertEqual(relay.transport.socket.getsockname()[1], port)
+
+    def test_expired(self):
+        data = snapshot.dumps(self.server)
+        server = self.create_server()
+        with mock.patch("time.time", return_value=2 ** 32):
+            self.assertEqual(snapshot.restore(server, data), 0)
+
+    def test_corrupt_family(self):
+        data = snapshot.dumps(self.server)
+        server = self.create_server()
+        permission_offset = data.index(socket.inet_aton("10.0.0.2"))
+        # Family of the client address, and of the permission
+        for offset in (snapshot._header_struct.size, permission_offset - 5):
+            corrupt = bytearray(data)
+            corrupt[offset] = 3
+            with self.assertRaises(ValueError):
+                snapshot.restore(server, corrupt)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot")
+            server = self.create_server()
+            self.assertEqual(snapshot.load(server, path), 0)
+            snapshot.save(self.server, path)
+            self.assertEqual(os.listdir(directory), ["snapshot"])
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(4), snapshot.MAGIC)
+
+    def test_handoff(self):
+        self.server.transport = SocketTransport(
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        )
+        self.server.transport.socket.bind(("127.0.0.1", 0))
+        self.addCleanup(self.server.transport.stopListening)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "handoff")
+            self.assertEqual(snapshot.receive_handoff(path), (None, None, None))
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            listener.bind(path)
+            listener.listen()
+
+            def accept():
+                conn, _addr = listener.accept()
+                with conn, listener:
+                    snapshot.send_handoff(self.server, conn)
+
+            thread = threading.Thread(target=accept)
+            thread.start()
+            data, sock, relay_sockets = snapshot.receive_handoff(path)
+            thread.join()
+        with sock:
+            self.assertEqual(
+                sock.getsockname(), self.server.transport.socket.getsockname()
+            )
+        # Equal but for the time of the snapshot
+        header_size = snapshot._header_struct.size
+        self.assertEqual(data[header_size:], snapshot.dumps(self.server)[header_size:])
+        self.assertEqual(list(relay_sockets), [self.relay.relay_addr[1]])
+        relay_sockets.popitem()[1].close()
+
+
+if __name__ == "__main__":
+    unittest.main()
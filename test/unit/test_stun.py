@@ -1,9 +1,19 @@
 import unittest
 import codecs
+import socket
+import time
+from unittest import mock
+from twisted.internet import task
 from jostedal import stun
 from jostedal.stun.agent import Message, Address, Unknown
+from jostedal.stun.agent import zero_padding, RandomPoolPadding
 from jostedal.stun import attributes
-from jostedal.utils import ha1
+from jostedal.stun.server import BindingResponseTemplate, ResponseCache
+from jostedal.stun.authentication import (
+    LongTermCredentialMechanism,
+    TimeLimitedCredentialMechanism,
+)
+from jostedal.utils import ha1, AddressCache
 
 
 class MessageTest(unittest.TestCase):
@@ -90,6 +100,323 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(Message.decode(msg), msg_data)
 
 
+class LazyDecodeTest(unittest.TestCase):
+    def setUp(self):
+        msg = Message.from_str(
+            stun.METHOD_BINDING, stun.CLASS_REQUEST, transaction_id=b"fixedtransid"
+        )
+        msg.add_attr(attributes.Username, "johndoe")
+        msg.add_attr(
+            attributes.XorMappedAddress, Address.FAMILY_IPv4, 1337, "192.168.2.255"
+        )
+        msg.add_attr(attributes.Software, "jostedal")
+        self.data = bytes(msg)
+
+    def test_attributes_decoded_on_demand(self):
+        msg = Message.from_buffer(self.data, lazy=True)
+        self.assertEqual(msg._attributes, [None, None, None])
+
+        address = msg.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual((address.port, address.address), (1337, "192.168.2.255"))
+        self.assertIs(msg._attributes[1], address)
+        self.assertIsNone(msg._attributes[0])
+        self.assertIs(msg.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS), address)
+
+    def test_lazy_matches_eager(self):
+        lazy = Message.from_buffer(self.data, lazy=True)
+        eager = Message.from_buffer(self.data)
+        self.assertEqual(lazy, eager)
+        self.assertEqual(lazy.attributes, eager.attributes)
+        self.assertEqual(lazy.get_attr(stun.ATTR_SOFTWARE), b"jostedal")
+
+    def test_malformed_attribute(self):
+        data = bytearray(self.data)
+        data[37] = Address.FAMILY_IPv6  # IPv6 family with an IPv4 address
+        msg = Message.from_buffer(data, lazy=True)
+        with self.assertRaises(stun.BadRequestError):
+            msg.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        data[37] = 3  # Unknown family
+        msg = Message.from_buffer(data, lazy=True)
+        with self.assertRaises(stun.BadRequestError):
+            msg.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertIn("<malformed attribute 0x0020, 8 bytes>", msg.format())
+
+
+class AttributeIndexTest(unittest.TestCase):
+    def setUp(self):
+        msg = Message.from_str(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS)
+        msg.add_attr(
+            attributes.XorMappedAddress, Address.FAMILY_IPv4, 1337, "192.168.2.255"
+        )
+        msg.add_attr(attributes.MappedAddress, Address.FAMILY_IPv4, 80, "10.0.0.1")
+        msg.add_attr(attributes.Software, "first")
+        msg.add_attr(attributes.Software, "second")
+        self.msg = msg
+
+    def test_get_attr_returns_first(self):
+        for msg in (self.msg, Message.from_buffer(self.msg, lazy=True)):
+            self.assertEqual(msg.get_attr(stun.ATTR_SOFTWARE), b"first")
+            address = msg.get_attr(
+                stun.ATTR_MAPPED_ADDRESS, stun.ATTR_XOR_MAPPED_ADDRESS
+            )
+            self.assertEqual(address.type, stun.ATTR_XOR_MAPPED_ADDRESS)
+            self.assertIsNone(msg.get_attr(stun.ATTR_NONCE))
+
+    def test_get_attrs(self):
+        msg = Message.from_buffer(self.msg, lazy=True)
+        software, nonce, address = msg.get_attrs(
+            stun.ATTR_SOFTWARE, stun.ATTR_NONCE, stun.ATTR_MAPPED_ADDRESS
+        )
+        self.assertEqual(software, b"first")
+        self.assertIsNone(nonce)
+        self.assertEqual(address.port, 80)
+
+
+class BindingResponseTemplateTest(unittest.TestCase):
+    def expected_response(self, transaction_id, family, port, host):
+        response = Message.from_str(
+            stun.METHOD_BINDING,
+            stun.CLASS_RESPONSE_SUCCESS,
+            transaction_id=transaction_id,
+        )
+        response._padding = bytes
+        response.add_attr(attributes.XorMappedAddress, family, port, host)
+        response.add_attr(attributes.Software, "jostedal")
+        response.add_attr(attributes.Fingerprint)
+        return response
+
+    def test_render(self):
+        for family, host in (
+            (Address.FAMILY_IPv4, "192.168.2.255"),
+            (Address.FAMILY_IPv6, "2001:db8::1"),
+        ):
+            template = BindingResponseTemplate(family, "jostedal")
+            for transaction_id, port in ((b"fixedtransid", 1337), (b"x" * 12, 80)):
+                self.assertEqual(
+                    template.render(transaction_id, port, host),
+                    self.expected_response(transaction_id, family, port, host),
+                )
+
+    def test_render_decodes(self):
+        template = BindingResponseTemplate(Address.FAMILY_IPv4, "jostedal")
+        response = Message.from_buffer(
+            template.render(b"fixedtransid", 1337, "10.0.0.1")
+        )
+        address = response.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual((address.address, address.port), ("10.0.0.1", 1337))
+        self.assertEqual(response.transaction_id, b"fixedtransid")
+
+
+class AddressTest(unittest.TestCase):
+    def test_xor_address_round_trip(self):
+        for family, host in (
+            (Address.FAMILY_IPv4, "192.168.2.255"),
+            (Address.FAMILY_IPv6, "2001:db8::dead:beef"),
+        ):
+            msg = Message.from_str(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+            encoded = msg.add_attr(attributes.XorMappedAddress, family, 1337, host)
+            decoded = Message.from_buffer(msg).get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+            self.assertEqual(decoded, encoded)
+            self.assertEqual((decoded.port, decoded.address), (1337, host))
+            self.assertEqual(decoded.packed_ip, encoded.packed_ip)
+            self.assertEqual(
+                decoded.packed_ip, socket.inet_pton(Address.ftoaf(family), host)
+            )
+
+    def test_xor_ipv4_known_value(self):
+        msg = Message.from_str(
+            stun.METHOD_BINDING, stun.CLASS_REQUEST, transaction_id=b"fixedtransid"
+        )
+        address = msg.add_attr(
+            attributes.XorMappedAddress, Address.FAMILY_IPv4, 1337, "192.168.2.255"
+        )
+        self.assertEqual(address, codecs.decode("0001242be1baa6bd", "hex"))
+
+
+class AddressCacheTest(unittest.TestCase):
+    def test_cache(self):
+        cache = AddressCache(maxsize=2)
+        packed_ip = socket.inet_pton(socket.AF_INET, "10.0.0.1")
+        first = cache.ntop(socket.AF_INET, packed_ip)
+        second = cache.ntop(socket.AF_INET, bytes(packed_ip))
+        self.assertEqual(first, "10.0.0.1")
+        self.assertIs(first, second)
+        self.assertEqual(cache.pton(socket.AF_INET, "10.0.0.1"), packed_ip)
+
+        stats = cache.stats()
+        self.assertEqual((stats["ntop_hits"], stats["ntop_misses"]), (1, 1))
+        self.assertEqual((stats["pton_hits"], stats["pton_misses"]), (0, 1))
+
+        for host in ("10.0.0.2", "10.0.0.3", "10.0.0.4"):
+            cache.pton(socket.AF_INET, host)
+        self.assertEqual(cache.stats()["pton_size"], 2)
+
+        cache.resize(8)
+        self.assertEqual(cache.stats()["ntop_size"], 0)
+
+
+class PaddingTest(unittest.TestCase):
+    def test_zero_padding(self):
+        msg = Message.from_str(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        msg._padding = zero_padding
+        msg.add_attr(attributes.Software, "abcde")
+        self.assertEqual(msg[-3:], b"\x00\x00\x00")
+        self.assertEqual(msg.length % 4, 0)
+
+    def test_random_pool_padding(self):
+        padding = RandomPoolPadding(pool_size=8)
+        lengths = [3, 2, 3, 1, 3]
+        self.assertEqual([len(padding(length)) for length in lengths], lengths)
+
+
+class MessageIntegrityTest(unittest.TestCase):
+    def test_prepared_key(self):
+        key = ha1("username", "realm", "password")
+        prepared = attributes.MessageIntegrity.prepare_key(key)
+        digests = []
+        for k in (key, prepared, prepared):
+            msg = Message.from_str(
+                stun.METHOD_BINDING, stun.CLASS_REQUEST, transaction_id=b"x" * 12
+            )
+            digests.append(bytes(msg.add_attr(attributes.MessageIntegrity, k)))
+        self.assertEqual(digests[0], digests[1])
+        self.assertEqual(digests[1], digests[2])
+
+
+class AuthenticationTest(unittest.TestCase):
+    def setUp(self):
+        self.mechanism = LongTermCredentialMechanism(
+            "realm", {"user": {"password": "pass"}}
+        )
+        self.key = ha1("user", "realm", "pass")
+
+    addr = ("10.0.0.1", 5000)
+
+    def request(self, key, nonce=None, username="user"):
+        nonce = nonce or self.mechanism.generate_nonce(self.addr).encode()
+        msg = Message.from_str(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        msg.add_attr(attributes.Username, username)
+        msg.add_attr(attributes.Realm, b"realm")
+        msg.add_attr(attributes.Nonce, nonce)
+        msg.add_attr(attributes.MessageIntegrity, key)
+        msg.add_attr(attributes.Fingerprint)
+        return Message.from_buffer(bytes(msg), lazy=True)
+
+    def test_authenticated(self):
+        msg = self.request(self.key)
+        self.mechanism.authenticate(msg, self.addr)
+        response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
+        self.mechanism.update(response)
+        response = Message.from_buffer(bytes(response))
+        self.assertTrue(attributes.MessageIntegrity.verify(response, self.key))
+
+    def test_rejected(self):
+        for msg in (
+            self.request(ha1("user", "realm", "wrong")),
+            self.request(self.key, username="other"),
+        ):
+            self.assertRaises(
+                stun.UnauthorizedError, self.mechanism.authenticate, msg, self.addr
+            )
+        msg = self.request(self.key)
+        msg[10] ^= 1  # Transaction id
+        self.assertRaises(
+            stun.UnauthorizedError, self.mechanism.authenticate, msg, self.addr
+        )
+
+    def test_stale_nonce(self):
+        issued = time.time() - self.mechanism.nonce_lifetime
+        with mock.patch("time.time", return_value=issued):
+            expired = self.mechanism.generate_nonce(self.addr).encode()
+        other_client = self.mechanism.generate_nonce(("10.0.0.2", 5000)).encode()
+        for nonce in (b"stale", expired, other_client):
+            msg = self.request(self.key, nonce=nonce)
+            self.assertRaises(
+                stun.StaleNonceError, self.mechanism.authenticate, msg, self.addr
+            )
+        # Only for requests with valid message integrity
+        msg = self.request(ha1("user", "realm", "wrong"), nonce=expired)
+        self.assertRaises(
+            stun.UnauthorizedError, self.mechanism.authenticate, msg, self.addr
+        )
+
+    def test_shared_nonce_secret(self):
+        other = LongTermCredentialMechanism("realm", nonce_secret=b"secret")
+        self.mechanism.nonce_secret = b"secret"
+        msg = self.request(self.key, nonce=other.generate_nonce(self.addr).encode())
+        self.mechanism.authenticate(msg, self.addr)
+
+    def test_challenge(self):
+        response = self.request(self.key).create_response(stun.CLASS_RESPONSE_ERROR)
+        self.mechanism.update(response, self.addr)
+        self.assertIsNotNone(response.get_attr(stun.ATTR_NONCE))
+        self.assertIsNone(response.get_attr(stun.ATTR_MESSAGE_INTEGRITY))
+
+
+class TimeLimitedCredentialTest(unittest.TestCase):
+    def setUp(self):
+        self.mechanism = TimeLimitedCredentialMechanism(
+            "realm", "secret", {"static": {"password": "pass"}}, cache_size=2
+        )
+
+    def test_derived_key(self):
+        username, password = self.mechanism.generate_credentials("alice")
+        key = self.mechanism.get_key(username)
+        self.assertEqual(
+            attributes.MessageIntegrity.compute(key, b"data"),
+            attributes.MessageIntegrity.compute(
+                ha1(username, "realm", password), b"data"
+            ),
+        )
+        self.assertIs(self.mechanism.get_key(username), key)
+        self.assertIsNotNone(self.mechanism.get_key("static"))
+        self.assertIsNone(self.mechanism.get_key("unknown"))
+
+    def test_expiry(self):
+        username, _password = self.mechanism.generate_credentials("alice", 10)
+        self.assertIsNotNone(self.mechanism.get_key(username))
+        with mock.patch("time.time", return_value=time.time() + 10):
+            self.assertIsNone(self.mechanism.get_key(username))
+        self.assertEqual(len(self.mechanism._key_cache), 0)
+        self.assertIsNone(self.mechanism.get_key("1:alice"))
+
+    def test_bounded(self):
+        for name in ("alice", "bob", "carol"):
+            username, _password = self.mechanism.generate_credentials(name)
+            self.mechanism.get_key(username)
+        self.assertEqual(len(self.mechanism._key_cache), 2)
+        self.assertEqual(self.mechanism.hmac_keys.keys(), {"static"})
+
+
+class ResponseCacheTest(unittest.TestCase):
+    addr = ("10.0.0.1", 5000)
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ResponseCache(self.clock, timeout=40, maxsize=2)
+
+    def test_timeout(self):
+        self.cache.add(self.addr, b"a" * 12, b"response")
+        self.assertEqual(self.cache.get(self.addr, b"a" * 12), b"response")
+        self.assertIsNone(self.cache.get(("10.0.0.2", 5000), b"a" * 12))
+        self.clock.advance(40)
+        self.assertIsNone(self.cache.get(self.addr, b"a" * 12))
+        self.cache.add(self.addr, b"b" * 12, b"response")
+        self.assertEqual(len(self.cache), 1)
+
+    def test_maxsize(self):
+        for transaction_id in (b"a" * 12, b"b" * 12, b"c" * 12):
+            self.cache.add(self.addr, transaction_id, transaction_id)
+        self.assertIsNone(self.cache.get(self.addr, b"a" * 12))
+        self.assertEqual(self.cache.get(self.addr, b"c" * 12), b"c" * 12)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_first_response_kept(self):
+        self.cache.add(self.addr, b"a" * 12, b"first")
+        self.cache.add(self.addr, b"a" * 12, b"second")
+        self.assertEqual(self.cache.get(self.addr, b"a" * 12), b"first")
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,35 @@
+import os
+import signal
+import unittest
+from jostedal.supervisor import Supervisor
+
+
+class SupervisorTest(unittest.TestCase):
+    def test_worker_sockets(self):
+        supervisor = Supervisor(3, None, address=("127.0.0.1", 0))
+        supervisor._bind_sockets()
+        for sock in supervisor._sockets:
+            self.addCleanup(sock.close)
+        ports = {sock.getsockname()[1] for sock in supervisor._sockets}
+        self.assertEqual(len(supervisor._sockets), 3)
+        self.assertEqual(len(ports), 1)
+        # A restarted worker gets a copy of the same socket
+        with supervisor.worker_socket(1) as sock:
+            self.assertNotEqual(sock.fileno(), supervisor._sockets[1].fileno())
+            self.assertEqual(sock.getsockname(), supervisor._sockets[1].getsockname())
+
+    def test_reload_before_handler(self):
+        def worker_main(index):
+            os.kill(os.getpid(), signal.SIGHUP)
+
+        supervisor = Supervisor(1, worker_main)
+        supervisor._spawn(0)
+        (pid,) = supervisor._pids
+        _pid, status = os.waitpid(pid, 0)
+        # Not killed by SIGHUP before installing its reload handler
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
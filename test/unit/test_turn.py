@@ -0,0 +1,541 @@
+import unittest
+import socket
+import struct
+from unittest import mock
+from twisted.internet import defer, task
+from jostedal import stun, turn
+from jostedal.stun import attributes as stun_attributes
+from jostedal.stun.agent import Message
+from jostedal.stun.authentication import LongTermCredentialMechanism
+from jostedal.stun.credentials import CredentialsPending
+from jostedal.stun.server import ResponseCache
+from jostedal.turn import attributes
+from jostedal.turn.relay import PermissionTable, Relay, RelayPortPool
+from jostedal.turn.server import TurnUdpServer
+from jostedal.utils import TimerWheel, TokenBucket, ha1, address_cache
+
+
+class FakeTransport(object):
+    addressFamily = socket.AF_INET
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, addr):
+        self.written.append((bytes(data), addr))
+
+    def stopListening(self):
+        self.closed = True
+
+
+class TurnServerTestCase(unittest.TestCase):
+    """Server on a `task.Clock`, responding through a `FakeTransport`"""
+
+    client_addr = ("10.0.0.1", 5000)
+    peer_addr = ("10.0.0.2", 6000)
+    users = {
+        username: {"password": "pass"} for username in ("user", "alice", "bob", "carol")
+    }
+
+    def setUp(self):
+        self.clock = task.Clock()
+        credential_mechanism = LongTermCredentialMechanism("realm", self.users)
+        self.server = TurnUdpServer(
+            self.clock, "127.0.0.1", 0, "jostedal", credential_mechanism
+        )
+        self.server.transport = FakeTransport()
+
+    def create_relay(self, client_addr=None):
+        """Relay for `client_addr` added to the server, relaying through a
+        `FakeTransport`
+        """
+        relay = Relay(self.server, client_addr or self.client_addr)
+        relay.transport = FakeTransport()
+        self.server._relays[relay.client_addr] = relay
+        return relay
+
+    def bind_relay_sockets(self):
+        """Allocate relays on bound sockets, relaying through `FakeTransport`s"""
+        self.server.relay_ports = RelayPortPool("127.0.0.1", size=0)
+        self.server.adopt_udp = self._adopt_udp
+
+    def _adopt_udp(self, sock, protocol):
+        protocol.transport = FakeTransport()
+        protocol.transport.socket = sock
+        self.addCleanup(sock.close)
+        return protocol.transport
+
+    def authenticated_request(self, method, username="user", addr=None):
+        """Request from `addr` with the long-term credentials of `username`"""
+        addr = addr or self.client_addr
+        request = Message.from_str(method, stun.CLASS_REQUEST)
+        request.add_attr(attributes.RequestedTransport, turn.TRANSPORT_UDP)
+        request.add_attr(stun_attributes.Username, username)
+        request.add_attr(stun_attributes.Realm, b"realm")
+        nonce = self.server.credential_mechanism.generate_nonce(addr)
+        request.add_attr(stun_attributes.Nonce, nonce.encode())
+        request.add_attr(
+            stun_attributes.MessageIntegrity, ha1(username, "realm", "pass")
+        )
+        return request
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(self.clock, tick=1.0, size=8)
+        self.wheel.start()
+        self.fired = []
+
+    def test_fires_when_due(self):
+        self.wheel.schedule(2.5, self.fired.append, "a")
+        self.wheel.schedule(1.0, self.fired.append, "b")
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["b"])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["b"])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["b", "a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_deadline_beyond_span(self):
+        self.wheel.schedule(20, self.fired.append, "a")
+        self.clock.pump([1] * 19)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_catch_up(self):
+        self.wheel.schedule(3, self.fired.append, "a")
+        self.clock.advance(5)
+        self.assertEqual(self.fired, ["a"])
+        self.wheel.schedule(6, self.fired.append, "b")
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_due(self):
+        self.clock.advance(2)
+        self.assertTrue(self.wheel.due(2, self.fired.append, "a"))
+        self.assertFalse(self.wheel.due(3, self.fired.append, "a"))
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_stop(self):
+        self.wheel.schedule(1, self.fired.append, "a")
+        self.wheel.stop()
+        self.clock.advance(2)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class PermissionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(self.clock)
+        self.wheel.start()
+        self.permissions = PermissionTable(self.wheel)
+
+    def test_expiry(self):
+        self.permissions.add("10.0.0.1")
+        self.assertIn("10.0.0.1", self.permissions)
+        self.assertNotIn("10.0.0.2", self.permissions)
+        self.clock.pump([1] * 299)
+        self.assertIn("10.0.0.1", self.permissions)
+        self.clock.advance(1)
+        self.assertNotIn("10.0.0.1", self.permissions)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_refresh(self):
+        self.permissions.add("10.0.0.1")
+        self.clock.pump([1] * 200)
+        self.permissions.add("10.0.0.1")
+        self.clock.pump([1] * 200)
+        self.assertIn("10.0.0.1", self.permissions)
+        self.clock.pump([1] * 100)
+        self.assertNotIn("10.0.0.1", self.permissions)
+        self.assertEqual(len(self.permissions), 0)
+
+
+class RelayPortPoolTest(unittest.TestCase):
+    def setUp(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        self.first = probe.getsockname()[1]
+        probe.close()
+        self.pool = RelayPortPool("127.0.0.1", (self.first, self.first), size=4)
+        self.addCleanup(self.pool.close)
+
+    def test_fill(self):
+        self.pool.fill()
+        self.assertEqual(len(self.pool), 1)
+        sock = self.pool.take()
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getsockname()[1], self.first)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_exhausted(self):
+        sock = self.pool.take()
+        self.assertRaises(turn.InsufficientCapacityError, self.pool.take)
+        sock.close()
+        self.pool.release(self.first)
+        self.pool.take().close()
+
+    def test_ephemeral(self):
+        pool = RelayPortPool("127.0.0.1", size=2)
+        pool.fill()
+        self.assertEqual(len(pool), 2)
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+
+class ChannelDataTest(TurnServerTestCase):
+    def setUp(self):
+        TurnServerTestCase.setUp(self)
+        self.relay = self.create_relay()
+
+        msg = Message.from_str(turn.METHOD_CHANNEL_BIND, 0)
+        peer = msg.add_attr(attributes.XorPeerAddress, 1, 6000, "10.0.0.2")
+        self.relay.bind_channel(0x4001, peer)
+
+    def test_relayed_to_peer(self):
+        datagram = struct.pack(">2H", 0x4001, 3) + b"abc" + b"\x00"
+        self.server.datagramReceived(datagram, self.client_addr)
+        self.assertEqual(self.relay.transport.written, [(b"abc", self.peer_addr)])
+
+    def test_peer_data_to_client(self):
+        self.relay.datagramReceived(b"xyz", self.peer_addr)
+        self.relay.datagramReceived(b"abcdef", self.peer_addr)
+        self.assertEqual(
+            self.server.transport.written,
+            [
+                (struct.pack(">2H", 0x4001, 3) + b"xyz", self.client_addr),
+                (struct.pack(">2H", 0x4001, 6) + b"abcdef", self.client_addr),
+            ],
+        )
+
+    def test_discarded(self):
+        for datagram, addr in (
+            (struct.pack(">2H", 0x4002, 3) + b"abc", self.client_addr),
+            (struct.pack(">2H", 0x4001, 3) + b"abc", ("10.0.0.3", 5000)),
+            (struct.pack(">2H", 0x4001, 8) + b"abc", self.client_addr),
+            (b"\x40\x01", self.client_addr),
+        ):
+            self.server.datagramReceived(datagram, addr)
+        self.assertEqual(self.relay.transport.written, [])
+
+
+class RelayLoggingTest(TurnServerTestCase):
+    def setUp(self):
+        TurnServerTestCase.setUp(self)
+        self.server.log_sample_rate = 10
+        self.server.timer_wheel.start()
+
+    def create_relay(self):
+        relay = TurnServerTestCase.create_relay(self)
+        relay.add_permission(self.peer_addr[0])
+        return relay
+
+    def test_sampled(self):
+        with self.assertLogs("jostedal.turn.relay", "INFO") as logs:
+            relay = self.create_relay()
+            for _ in range(25):
+                relay.send(b"data", self.peer_addr)
+        sent = [line for line in logs.output if "->" in line]
+        self.assertEqual(len(sent), 3)
+        self.assertEqual((relay.packets_sent, relay.bytes_sent), (25, 100))
+
+    def test_stats(self):
+        relay = self.create_relay()
+        relay.send(b"data", self.peer_addr)
+        relay.datagramReceived(b"abc", self.peer_addr)
+        stats = self.server.stats()
+        self.assertEqual(stats["allocations"], 1)
+        self.assertEqual((stats["packets_sent"], stats["bytes_sent"]), (1, 4))
+        self.assertEqual((stats["packets_received"], stats["bytes_received"]), (1, 3))
+        for key, value in address_cache.stats().items():
+            self.assertEqual(stats["address_cache_" + key], value)
+        relay.deallocate = mock.Mock()
+        self.server._deallocate(self.client_addr)
+        relay = self.create_relay()
+        relay.send(b"data", self.peer_addr)
+        stats = self.server.stats()
+        self.assertEqual(stats["allocations"], 1)
+        self.assertEqual((stats["packets_sent"], stats["bytes_sent"]), (2, 8))
+        self.assertEqual((stats["packets_received"], stats["bytes_received"]), (1, 3))
+
+    def test_summary(self):
+        with self.assertLogs("jostedal.turn.relay", "INFO") as logs:
+            relay = self.create_relay()
+            relay._schedule_summary()
+            relay.datagramReceived(b"data", ("10.0.0.3", 6000))
+            self.clock.pump([1] * 60)
+            self.clock.pump([1] * 60)
+        summaries = [line for line in logs.output if "Sent" in line]
+        self.assertEqual(len(summaries), 1)
+        self.assertIn("dropped 1 packets", summaries[0])
+
+
+class ExpiryTest(TurnServerTestCase):
+    def setUp(self):
+        TurnServerTestCase.setUp(self)
+        self.server.relay_ports = RelayPortPool("127.0.0.1", (40000, 40001))
+        self.server.timer_wheel.start()
+        self.relay = self.create_relay()
+        self.relay.relay_addr = (1, 40000, "127.0.0.1")
+
+    def test_allocation(self):
+        self.relay.refresh(600)
+        self.clock.pump([1] * 300)
+        self.relay.refresh(600)
+        self.clock.pump([1] * 599)
+        self.assertIn(self.client_addr, self.server._relays)
+        self.clock.advance(1)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertTrue(self.relay.transport.closed)
+        self.assertIn(40000, self.server.relay_ports._ports)
+
+    def test_refresh_shorter(self):
+        self.relay.refresh(600)
+        self.relay.refresh(300)
+        self.clock.pump([1] * 200)
+        self.relay.refresh(600)
+        self.clock.pump([1] * 599)
+        # The timer superseded by the shorter lifetime was not rescheduled
+        self.assertEqual(len(self.server.timer_wheel), 1)
+        self.assertIn(self.client_addr, self.server._relays)
+        self.clock.advance(1)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertEqual(len(self.server.timer_wheel), 0)
+
+    def test_channel(self):
+        self.relay.refresh(3600)
+        msg = Message.from_str(turn.METHOD_CHANNEL_BIND, 0)
+        peer = msg.add_attr(attributes.XorPeerAddress, 1, 6000, "10.0.0.2")
+        self.relay.bind_channel(0x4001, peer)
+        self.clock.pump([1] * 599)
+        self.assertIn(0x4001, self.relay._addresses)
+        self.clock.advance(1)
+        self.assertNotIn(0x4001, self.relay._addresses)
+        self.assertEqual(self.relay._channels, {})
+
+    def test_expired_allocation(self):
+        self.relay.refresh(600)
+        self.clock.pump([1] * 600)
+        self.server.credential_mechanism.authenticate = mock.Mock()
+        for method in (turn.METHOD_CREATE_PERMISSION, turn.METHOD_CHANNEL_BIND):
+            msg = Message.from_str(method, stun.CLASS_REQUEST)
+            msg.add_attr(attributes.XorPeerAddress, 1, 6000, "10.0.0.2")
+            self.server.datagramReceived(bytes(msg), self.client_addr)
+        msg = Message.from_str(turn.METHOD_SEND, stun.CLASS_INDICATION)
+        msg.add_attr(attributes.XorPeerAddress, 1, 6000, "10.0.0.2")
+        msg.add_attr(attributes.Data, b"data")
+        self.server.datagramReceived(bytes(msg), self.client_addr)
+        responses = [
+            Message.from_buffer(data) for data, _addr in self.server.transport.written
+        ]
+        self.assertEqual(
+            [response.get_attr(stun.ATTR_ERROR_CODE).code for response in responses],
+            [437, 437],
+        )
+
+
+class AdmissionTest(TurnServerTestCase):
+    def setUp(self):
+        TurnServerTestCase.setUp(self)
+        self.bind_relay_sockets()
+
+    def allocate(self, username, port):
+        """Send an Allocate request from port `port` of the client
+        :returns: the error code of the response, None for success
+        """
+        addr = ("10.0.0.1", port)
+        request = self.authenticated_request(turn.METHOD_ALLOCATE, username, addr)
+        self.server.datagramReceived(bytes(request), addr)
+        response = Message.from_buffer(self.server.transport.written[-1][0])
+        error_code = response.get_attr(stun.ATTR_ERROR_CODE)
+        return error_code and error_code.code
+
+    def assertRejected(self, code, username, port):
+        relays = dict(self.server._relays)
+        with mock.patch.object(self.server.relay_ports, "take") as take:
+            self.assertEqual(self.allocate(username, port), code)
+        take.assert_not_called()
+        self.assertEqual(self.server._relays, relays)
+
+    def test_user_quota(self):
+        self.server.user_quota = 2
+        self.assertIsNone(self.allocate("alice", 1))
+        self.assertIsNone(self.allocate("alice", 2))
+        self.assertIsNone(self.allocate("bob", 3))
+        self.assertRejected(486, "alice", 4)
+        self.server._deallocate(("10.0.0.1", 1))
+        self.assertIsNone(self.allocate("alice", 4))
+        self.assertEqual(self.server._user_allocations, {b"alice": 2, b"bob": 1})
+
+    def test_capacity(self):
+        self.server.max_allocations = 2
+        self.assertIsNone(self.allocate("alice", 1))
+        self.assertIsNone(self.allocate("bob", 2))
+        self.assertRejected(508, "carol", 3)
+
+    def test_bandwidth(self):
+        self.server.max_bandwidth = 100000
+        self.server.allocation_bandwidth = 50000
+        self.assertIsNone(self.allocate("alice", 1))
+        self.assertIsNone(self.allocate("bob", 2))
+        self.assertRejected(508, "carol", 3)
+        # Shaped allocations reserve their rate
+        self.server.allocation_rate = 25000
+        self.assertIsNone(self.allocate("carol", 3))
+        self.assertIsNone(self.allocate("carol", 4))
+        self.assertRejected(508, "carol", 5)
+
+
+class ShapingTest(TurnServerTestCase):
+    def create_relay(self, port, username=b"alice"):
+        relay = TurnServerTestCase.create_relay(self, ("10.0.0.1", port))
+        relay.username = username
+        relay.add_permission(self.peer_addr[0])
+        self.server._shape(relay)
+        return relay
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(self.clock, rate=100, burst=200)
+        self.assertTrue(bucket.consume(150))
+        self.assertFalse(bucket.consume(100))
+        self.clock.advance(0.5)
+        self.assertTrue(bucket.consume(100))
+        self.clock.advance(10)
+        self.assertTrue(bucket.consume(200))
+        self.assertFalse(bucket.consume(1))
+
+    def test_allocation_rate(self):
+        self.server.allocation_rate = 10
+        relay = self.create_relay(1)
+        for _ in range(4):
+            relay.send(b"abcd", self.peer_addr)
+            relay.datagramReceived(b"abcd", self.peer_addr)
+        self.assertEqual(relay.packets_sent, 2)
+        self.assertEqual(relay.packets_received, 2)
+        self.assertEqual(relay.packets_shaped, 4)
+        self.clock.advance(1)
+        relay.send(b"abcd", self.peer_addr)
+        self.assertEqual(relay.packets_sent, 3)
+
+    def test_user_rate(self):
+        self.server.user_rate = 10
+        first = self.create_relay(1)
+        second = self.create_relay(2)
+        other = self.create_relay(3, b"bob")
+        for relay in (first, second, other):
+            relay.send(b"abcdef", self.peer_addr)
+        self.assertEqual(
+            [relay.packets_sent for relay in (first, second, other)], [1, 0, 1]
+        )
+
+
+class RetransmissionTest(TurnServerTestCase):
+    def test_cached_response(self):
+        request = Message.from_str(turn.METHOD_REFRESH, stun.CLASS_REQUEST)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        self.assertEqual(self.server.messages_received, 1)
+        first, second = self.server.transport.written
+        self.assertEqual(first, second)
+        response = Message.from_buffer(first[0])
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_ERROR)
+        self.assertEqual(response.transaction_id, request.transaction_id)
+
+    def test_short_datagram(self):
+        for datagram in (b"\x00", bytes(19)):
+            with self.assertLogs("jostedal.stun", "ERROR"):
+                self.server.datagramReceived(datagram, self.client_addr)
+        self.assertEqual(self.server.transport.written, [])
+
+    def test_response_logging_sampled(self):
+        self.server._response_log.sample_rate = 10
+        with self.assertLogs("jostedal.stun.server", "INFO") as logs:
+            self.server._response_log.update()
+            for _ in range(15):
+                request = Message.from_str(turn.METHOD_REFRESH, stun.CLASS_REQUEST)
+                self.server.datagramReceived(bytes(request), self.client_addr)
+                self.server.datagramReceived(bytes(request), self.client_addr)
+        sent = [line for line in logs.output if "response" in line]
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(self.server.responses_sent, 30)
+
+    def test_allocate_evicted(self):
+        self.bind_relay_sockets()
+        key = ha1("user", "realm", "pass")
+        request = self.authenticated_request(turn.METHOD_ALLOCATE)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        self.server._responses = ResponseCache(self.server.reactor)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        for data, _addr in self.server.transport.written:
+            response = Message.from_buffer(data)
+            self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+            self.assertTrue(stun_attributes.MessageIntegrity.verify(response, key))
+        self.assertEqual(len(self.server.transport.written), 2)
+
+    def test_credentials_pending(self):
+        lookup = defer.Deferred()
+        provider = mock.Mock(**{"lookup.return_value": lookup})
+        self.server.credential_mechanism = LongTermCredentialMechanism(
+            "realm", provider=provider
+        )
+        request = self.authenticated_request(turn.METHOD_REFRESH, "alice")
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        self.server._responses = ResponseCache(self.server.reactor)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        self.assertEqual(self.server.transport.written, [])
+        lookup.callback({"password": "pass"})
+        (written,) = self.server.transport.written
+        response = Message.from_buffer(written[0])
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 437)
+        self.assertEqual(self.server._pending, set())
+
+    def test_credentials_pending_failure(self):
+        pending = defer.Deferred()
+        handler = mock.Mock(
+            side_effect=[CredentialsPending(pending), RuntimeError("failed")]
+        )
+        self.server._handlers[(turn.METHOD_REFRESH, stun.CLASS_REQUEST)] = handler
+        request = Message.from_str(turn.METHOD_REFRESH, stun.CLASS_REQUEST)
+        self.server.datagramReceived(bytes(request), self.client_addr)
+        with self.assertLogs("jostedal.turn.server", "ERROR"):
+            pending.callback(None)
+        self.assertEqual(handler.call_count, 2)
+        self.assertEqual(self.server._pending, set())
+
+
+class ReconfigureTest(TurnServerTestCase):
+    def setUp(self):
+        TurnServerTestCase.setUp(self)
+        self.relay = self.create_relay()
+
+    def test_reconfigure(self):
+        credential_mechanism = LongTermCredentialMechanism("other")
+        self.server._binding_templates[1] = object()
+        self.server.reconfigure(
+            credential_mechanism, "jostedal 2", max_allocations=10, user_rate=1000
+        )
+        self.assertIs(self.server.credential_mechanism, credential_mechanism)
+        self.assertEqual(self.server.software, "jostedal 2")
+        self.assertEqual(self.server._binding_templates, {})
+        self.assertEqual((self.server.max_allocations, self.server.user_rate), (10, 1000))
+        self.assertIs(self.server._relays[self.client_addr], self.relay)
+
+    def test_unknown_setting(self):
+        self.assertRaises(
+            AttributeError,
+            self.server.reconfigure,
+            software="jostedal 2",
+            max_allocations=10,
+            unknown=1,
+        )
+        self.assertEqual(self.server.software, "jostedal")
+        self.assertIsNone(self.server.max_allocations)
+
+
+if __name__ == "__main__":
+    unittest.main()